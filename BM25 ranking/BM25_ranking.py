@@ -1,105 +1,750 @@
 # Import necessary modules
-import re
+import os
 import sys
 import math
+import heapq
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
 from collections import defaultdict
+from functools import partial
+from itertools import compress
+from operator import itemgetter, not_
+
+# Make the shared modules at the repository root importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer  # noqa: E402
+from common.cache import QueryCache  # noqa: E402
+from common.index_file import IndexFile, TermMapping, is_index_file, write_index  # noqa: E402
+from common.instrumentation import NULL_PROFILE, begin  # noqa: E402
+from common.parallel import iter_lines, map_shards  # noqa: E402
+from common.positions import decode_positions, encode_positions, min_distance  # noqa: E402
+from common.server import serve  # noqa: E402
+from common.sharding import ShardedIndex  # noqa: E402
+
+
+# Append a document to postings stored as token -> (doc ids, term frequencies) arrays
+def add_postings(postings, doc_id, tokens):
+    # Count the occurrences of every distinct token of the document
+    tfs = {}
+    for token in tokens:
+        tfs[token] = tfs.get(token, 0) + 1
+    for token, tf in tfs.items():
+        arrays = postings.get(token)
+        if arrays is None:
+            arrays = postings[token] = (array('I'), array('I'))
+        arrays[0].append(doc_id)
+        arrays[1].append(tf)
+
+
+# Append postings whose doc ids (shifted by offset) are larger than those already in target
+def extend_postings(target, postings, offset=0):
+    for token, (doc_ids, tfs) in postings.items():
+        arrays = target.get(token)
+        if arrays is None:
+            arrays = target[token] = (array('I'), array('I'))
+        arrays[0].extend([offset + doc_id for doc_id in doc_ids] if offset else doc_ids)
+        arrays[1].extend(tfs)
+
+
+# Return the frequency of a token in a document from its sorted (doc ids, term frequencies) arrays
+def posting_tf(postings, doc_id):
+    if postings is None:
+        return 0
+    doc_ids, tfs = postings
+    position = bisect_left(doc_ids, doc_id)
+    return tfs[position] if position < len(doc_ids) and doc_ids[position] == doc_id else 0
+
+
+# Index one line-aligned byte range of a file in a worker process
+def index_shard(filename, start, end, analyzer):
+    # Document ids are local to the shard and start at 0
+    doc_len = array('I')
+    postings = {}
+    for doc_id, line in enumerate(iter_lines(filename, start, end)):
+        tokens = analyzer.tokens(line)
+        doc_len.append(len(tokens))
+        add_postings(postings, doc_id, tokens)
+    return doc_len, postings
+
+
+# Build the index of one line-aligned byte range of a file in a worker process of a sharded search
+def open_shard(filename, start, end):
+    return InvertedIndex([line.strip() for line in iter_lines(filename, start, end)])
+
+
+# Define a class to represent a small in-memory segment of documents added after the build
+class Segment:
+    __slots__ = ('postings', 'doc_ids')
+
+    def __init__(self):
+        # Create an empty dictionary to store the postings (token -> (doc ids, term frequencies) arrays)
+        self.postings = {}
+        # Create an empty array to store the ids of the documents in the segment
+        self.doc_ids = array('I')
+
+    def add(self, doc_id, tokens):
+        # Add a tokenized document; documents must be added in increasing doc id order
+        self.doc_ids.append(doc_id)
+        add_postings(self.postings, doc_id, tokens)
+
+    @classmethod
+    def merge(cls, segments):
+        # Combine consecutive segments into one, keeping the postings sorted by doc id
+        merged = cls()
+        for segment in segments:
+            merged.doc_ids.extend(segment.doc_ids)
+            extend_postings(merged.postings, segment.postings)
+        return merged
 
 
 # Define a class to represent an inverted index
 class InvertedIndex:
-    def __init__(self, documents):
-        # Initialize the inverted index with the given documents
-        self.documents = documents
-        # Create an empty index to store the token-to-document mapping
-        self.index = defaultdict(list)
-        # Create an empty dictionary to store the term frequencies
-        self.term_freq = defaultdict(lambda: defaultdict(int))
-        # Create an empty dictionary to store the document lengths
-        self.doc_len = {}
+    def __init__(self, documents, k1=1.2, b=0.75, block_size=64, positional=False,
+                 merge_factor=8, background_merge=True, analyzer=None, instrumentation=None):
+        # Initialize the inverted index with a copy of the given documents
+        self.documents = list(documents)
+        # Store the analyzer that turns documents and queries into tokens
+        self.analyzer = analyzer or Analyzer()
+        # Store the number of live documents and the next doc id to assign
+        self.num_documents = len(documents)
+        self.next_doc_id = len(documents)
+        # Store the BM25 free parameters
+        self.k1 = k1
+        self.b = b
+        # Store the number of postings per block used by Block-Max WAND
+        self.block_size = block_size
+        # Create an empty array to store the length of every document, 0 once it is deleted and purged
+        self.doc_len = array('I')
         # Initialize the average document length to 0
         self.avg_dl = 0
+        # Create an empty dictionary to store the precomputed idf of each token
+        self.idf = {}
+        # Create an empty array to store the length-normalization factor of each document
+        self.doc_norm = array('d')
+        # Create an empty dictionary to store sorted (doc ids, term frequencies) arrays per token
+        self.postings = {}
+        # Create an empty dictionary to store the maximum score contribution of each token
+        self.upper_bound = {}
+        # Create an empty dictionary to store (last doc id, maximum score) per posting block of each token
+        self.block_bounds = {}
+        # The memory-mapped index file when the index is loaded from disk
+        self.index_file = None
+        # Record the compressed token positions of every document when positional is set
+        self.positional = positional
+        self.positions = defaultdict(dict)
+        # Create an empty dictionary to store the number of live documents containing each token
+        self.df = {}
+        # Initialize the total length of the live documents to 0
+        self.total_len = 0
+        # Create an empty list of segments holding documents added after the build
+        self.segments = []
+        # Create an empty set of deleted doc ids that are still present in the postings
+        self.deleted = set()
+        # Merge the segments once there are merge_factor of them, in a thread when background_merge is set
+        self.merge_factor = merge_factor
+        self.background_merge = background_merge
+        self.merge_thread = None
+        self.lock = threading.Lock()
+        # Count the changes of the index and remember the change the idf and WAND bounds belong to
+        self.generation = 0
+        self.statistics_generation = 0
+        self.bounds_generation = 0
+        # Cache the results of frequent queries and the postings of hot tokens until the index changes
+        self.cache = QueryCache()
+        # Profile searches and builds when an Instrumentation is given
+        self.instrumentation = instrumentation
         # Build the inverted index
         self.build_index()
 
     def build_index(self):
+        profile = begin(self.instrumentation, 'build')
         # Iterate over the documents and tokenize them
         for doc_id, document in enumerate(self.documents):
             # Tokenize the document
+            profile.phase('tokenize')
             tokens = self.tokenize(document)
+            profile.phase('invert')
+            profile.count('documents')
+            profile.count('tokens', len(tokens))
             # Store the length of the document
-            self.doc_len[doc_id] = len(tokens)
-            # Add to the total document length
-            self.avg_dl += len(tokens)
-            # Iterate over the tokens and update the index and term frequencies
-            for token in tokens:
-                # Add the document ID to the token's posting list
-                self.index[token].append(doc_id)
-                # Increment the term frequency for the token in the document
-                self.term_freq[token][doc_id] += 1
-        # Calculate the average document length
-        self.avg_dl /= len(self.documents)
+            self.doc_len.append(len(tokens))
+            # Append the document and its term frequencies to the postings of its tokens
+            add_postings(self.postings, doc_id, tokens)
+            # Store the compressed positions of every token of the document
+            if self.positional:
+                doc_positions = defaultdict(list)
+                for position, token in enumerate(tokens):
+                    doc_positions[token].append(position)
+                for token, positions in doc_positions.items():
+                    self.positions[token][doc_id] = encode_positions(positions)
+        # Precompute the query-independent parts of the BM25 formula
+        profile.phase('statistics')
+        self.compute_statistics()
+        profile.count('terms', len(self.postings))
+        profile.finish()
+
+    @classmethod
+    def from_file_parallel(cls, filename, workers=None, k1=1.2, b=0.75, block_size=64, analyzer=None):
+        # Build the index of a file with one line per document, tokenizing shards in worker processes
+        ii = cls([], k1, b, block_size, analyzer=analyzer)
+        ii.documents = None
+        for doc_len, postings in map_shards(partial(index_shard, analyzer=ii.analyzer), filename, workers):
+            # Shift the shard-local document ids by the number of documents before the shard
+            extend_postings(ii.postings, postings, len(ii.doc_len))
+            ii.doc_len.extend(doc_len)
+        # The merged statistics equal those of a serial build
+        ii.num_documents = ii.next_doc_id = len(ii.doc_len)
+        ii.compute_statistics()
+        return ii
+
+    def compute_statistics(self):
+        # Count the documents containing each token and the total length of the documents
+        self.df = {token: len(doc_ids) for token, (doc_ids, _) in self.postings.items()}
+        self.total_len = sum(self.doc_len)
+        # Precompute idf and the length normalization
+        self.refresh_statistics()
+        self.compute_bounds()
+
+    def compute_bounds(self):
+        # Store per-token and per-block score upper bounds of the postings for WAND
+        self.upper_bound = {}
+        self.block_bounds = {}
+        for token, (doc_ids, tfs) in self.postings.items():
+            self.upper_bound[token], self.block_bounds[token] = self.score_bounds(self.idf[token], doc_ids, tfs)
+        self.bounds_generation = self.generation
+
+    def local_statistics(self):
+        # Return the statistics a sharded search sums over all shards
+        return {'num_documents': self.num_documents, 'total_len': self.total_len, 'df': dict(self.df)}
+
+    def use_global_statistics(self, num_documents, total_len, df):
+        # Score with the statistics of a whole sharded collection instead of those of the local documents;
+        # the local postings are kept, so the index must not be updated afterwards
+        self.num_documents = num_documents
+        self.total_len = total_len
+        self.df = {token: df[token] for token in self.df}
+        self.generation += 1
+        self.refresh_statistics()
+        self.compute_bounds()
+
+    def refresh_statistics(self):
+        # Calculate the average document length of the live documents
+        self.avg_dl = self.total_len / self.num_documents if self.num_documents else 0
+        # Calculate the idf of every token once, using the number of documents containing it
+        self.idf = {token: self.idf_from_df(df) for token, df in self.df.items()}
+        # Calculate k1 * (1 - b + b * dl / avg_dl) for every document
+        self.doc_norm = array('d', [self.k1 * (1 - self.b + self.b * dl / self.avg_dl) if self.avg_dl else 0.0
+                                    for dl in self.doc_len])
+        self.statistics_generation = self.generation
+
+    def add_documents(self, documents):
+        # Index new documents into an in-memory segment and return their doc ids
+        if self.index_file is not None:
+            raise ValueError('an index loaded from disk is read-only')
+        segment = Segment()
+        for document in documents:
+            doc_id = self.next_doc_id
+            self.next_doc_id += 1
+            tokens = self.tokenize(document)
+            segment.add(doc_id, tokens)
+            # Update the global statistics
+            self.doc_len.append(len(tokens))
+            self.total_len += len(tokens)
+            self.num_documents += 1
+            for token in set(tokens):
+                self.df[token] = self.df.get(token, 0) + 1
+            if self.positional:
+                doc_positions = defaultdict(list)
+                for position, token in enumerate(tokens):
+                    doc_positions[token].append(position)
+                for token, positions in doc_positions.items():
+                    self.positions[token][doc_id] = encode_positions(positions)
+            if self.documents is not None:
+                self.documents.append(document)
+        with self.lock:
+            self.segments.append(segment)
+        self.generation += 1
+        self.maybe_merge_segments()
+        return segment.doc_ids
+
+    def delete_documents(self, doc_ids):
+        # Record deleted documents as tombstones; their postings are dropped by optimize
+        if self.index_file is not None:
+            raise ValueError('an index loaded from disk is read-only')
+        for doc_id in doc_ids:
+            if doc_id in self.deleted or not 0 <= doc_id < self.next_doc_id:
+                continue
+            if self.documents is None:
+                raise ValueError('deleting needs the text of the documents')
+            if self.documents[doc_id] is None:
+                # The document was deleted and purged before
+                continue
+            # Update the global statistics
+            for token in set(self.tokenize(self.documents[doc_id])):
+                self.df[token] -= 1
+                if not self.df[token]:
+                    del self.df[token]
+            self.total_len -= self.doc_len[doc_id]
+            self.num_documents -= 1
+            self.deleted.add(doc_id)
+        self.generation += 1
+
+    def maybe_merge_segments(self):
+        # Merge the segments once there are merge_factor of them
+        with self.lock:
+            if len(self.segments) < self.merge_factor:
+                return
+            if self.merge_thread is not None and self.merge_thread.is_alive():
+                return
+            if self.background_merge:
+                self.merge_thread = threading.Thread(target=self.merge_segments, daemon=True)
+                self.merge_thread.start()
+                return
+        self.merge_segments()
+
+    def merge_segments(self):
+        # Replace the current segments by one merged segment; segments added meanwhile are kept
+        with self.lock:
+            segments = list(self.segments)
+        merged = Segment.merge(segments)
+        with self.lock:
+            self.segments = [merged] + self.segments[len(segments):]
+
+    def optimize(self):
+        # Merge every segment into the main postings, drop deleted documents and recompute statistics
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+        with self.lock:
+            segments = self.segments
+            self.segments = []
+        for segment in segments:
+            # Segment doc ids are larger than the main ones, so the postings stay sorted
+            extend_postings(self.postings, segment.postings)
+        tokens = set()
+        for doc_id in self.deleted:
+            doc_tokens = set(self.tokenize(self.documents[doc_id]))
+            tokens.update(doc_tokens)
+            for token in doc_tokens:
+                if token in self.positions:
+                    self.positions[token].pop(doc_id, None)
+            self.doc_len[doc_id] = 0
+            self.documents[doc_id] = None
+        # Rewrite the postings of the tokens of deleted documents without them
+        for token in tokens:
+            doc_ids, tfs = self.postings[token]
+            kept = [i for i, doc_id in enumerate(doc_ids) if doc_id not in self.deleted]
+            if kept:
+                self.postings[token] = (array('I', [doc_ids[i] for i in kept]), array('I', [tfs[i] for i in kept]))
+            else:
+                del self.postings[token]
+        self.deleted = set()
+        self.compute_statistics()
+
+    def score_bounds(self, idf, doc_ids, tfs):
+        # Calculate the maximum score contribution of a token and of every block of its postings
+        weight = idf * (self.k1 + 1)
+        scores = [weight * tf / (tf + self.doc_norm[doc_id]) for doc_id, tf in zip(doc_ids, tfs)]
+        # Negative contributions can only lower a score, so the bounds are clipped at zero
+        block_last = array('I')
+        block_max = array('d')
+        for start in range(0, len(doc_ids), self.block_size):
+            end = min(start + self.block_size, len(doc_ids))
+            block_last.append(doc_ids[end - 1])
+            block_max.append(max(0.0, max(scores[start:end])))
+        return max(block_max), (block_last, block_max)
 
     def tokenize(self, text):
-        # Tokenize the text by splitting on whitespace and converting to lowercase
-        return re.split('[^a-zA-z]', text.lower())
+        # Tokenize the text with the analyzer of the index
+        return self.analyzer.tokens(text)
 
     def bm25_score(self, query, doc_id):
         # Calculate the BM25 score for the query and document
+        if self.statistics_generation != self.generation:
+            self.refresh_statistics()
         score = 0
+        if doc_id in self.deleted:
+            return score
+        with self.lock:
+            segments = list(self.segments)
         for token in self.tokenize(query):
             # Check if the token is in the index
-            if token not in self.index:
+            if token not in self.idf:
                 continue
-            # Calculate the document frequency (df) of the token
-            df = len(self.index[token])
-            # Calculate the inverse document frequency (idf) of the token
-            idf = math.log((len(self.documents) - df + 0.5) / (df + 0.5))
             # Calculate the term frequency (tf) of the token in the document
-            tf = self.term_freq[token][doc_id]
-            # Calculate the document length (dl) of the document
-            dl = self.doc_len[doc_id]
+            tf = posting_tf(self.postings.get(token), doc_id)
+            for segment in segments:
+                tf = tf or posting_tf(segment.postings.get(token), doc_id)
             # Calculate the BM25 score for the token
-            k1 = 1.2
-            b = 0.75
-            numerator = tf * (k1 + 1)
-            denominator = tf + k1 * (1 - b + b * dl / self.avg_dl)
-            score += idf * (numerator / denominator)
+            numerator = tf * (self.k1 + 1)
+            denominator = tf + self.doc_norm[doc_id]
+            score += self.idf[token] * (numerator / denominator)
         return score
 
-    def search(self, query):
-        # Calculate the BM25 score for the query and each document
-        scores = {}
-        for doc_id in range(len(self.documents)):
-            scores[doc_id] = self.bm25_score(query, doc_id)
-        # Return the sorted scores in descending order
-        return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    def search(self, query, k=10, proximity=0.0):
+        profile = begin(self.instrumentation, 'search', query)
+        # Return the cached result of a query seen since the last change of the index
+        profile.phase('tokenize')
+        tokens = self.tokenize(query)
+        profile.phase('cache')
+        key = (tuple(tokens), k, proximity)
+        results = self.cache.results.get(key, self.generation)
+        if results is not None:
+            profile.count('cache_hits')
+            profile.finish()
+            return list(results)
+        profile.count('cache_misses')
+        # Accumulate BM25 scores term-at-a-time over the postings of the query tokens only
+        if self.statistics_generation != self.generation:
+            self.refresh_statistics()
+        scores = defaultdict(float)
+        for token in tokens:
+            # Skip tokens that do not appear in any document
+            idf = self.idf.get(token)
+            if idf is None:
+                continue
+            weight = idf * (self.k1 + 1)
+            doc_norm = self.doc_norm
+            profile.phase('postings')
+            doc_ids, tfs = self.live_postings(token, profile)
+            profile.phase('score')
+            profile.count('postings_read', len(doc_ids))
+            for doc_id, tf in zip(doc_ids, tfs):
+                scores[doc_id] += weight * tf / (tf + doc_norm[doc_id])
+        # Add the proximity bonus of a positional index
+        if proximity:
+            profile.phase('proximity')
+            self.add_proximity_bonus(scores, tokens, proximity)
+        # Keep the k best scores in descending order, ties broken by document id
+        profile.phase('sort')
+        profile.count('documents_scored', len(scores))
+        profile.count('heap_operations', len(scores))
+        results = heapq.nlargest(k, scores.items(), key=lambda x: (x[1], -x[0]))
+        self.cache.results.put(key, self.generation, results)
+        profile.finish()
+        return list(results)
+
+    def live_postings(self, token, profile=NULL_PROFILE):
+        # Return the doc ids and term frequencies of a token over the main postings and the segments,
+        # without deleted documents. Without segments and deletions these are the main arrays themselves;
+        # otherwise the merged arrays of frequent tokens are kept in the posting cache
+        with self.lock:
+            segments = list(self.segments)
+        postings = self.postings[token] if token in self.postings else (array('I'), array('I'))
+        if not segments and not self.deleted:
+            return postings
+        cached = self.cache.postings.get(token, self.generation)
+        if cached is not None:
+            profile.count('posting_cache_hits')
+            return cached
+        profile.count('posting_cache_misses')
+        doc_ids, tfs = array('I', postings[0]), array('I', postings[1])
+        for segment in segments:
+            if token in segment.postings:
+                doc_ids.extend(segment.postings[token][0])
+                tfs.extend(segment.postings[token][1])
+        if self.deleted:
+            live = list(map(not_, map(self.deleted.__contains__, doc_ids)))
+            doc_ids, tfs = array('I', compress(doc_ids, live)), array('I', compress(tfs, live))
+        self.cache.postings.put(token, self.generation, (doc_ids, tfs), len(doc_ids))
+        return doc_ids, tfs
+
+    def search_wand(self, query, k=10, block_max=True, stats=None):
+        # Return the same top-k as search, skipping postings that cannot enter the current top-k with
+        # WAND bounds: the per-token upper bounds, or the per-block maxima when block_max is set.
+        # The documents are walked in ranges that end at the first end of a current posting block, so
+        # within a range every token has one bound. A range whose bounds cannot beat the k-th score is
+        # skipped; otherwise only the documents of its essential tokens, those the other tokens' bounds
+        # alone cannot lift into the top-k, are scored. When a dictionary is passed as stats it is filled
+        # with posting and document counters.
+        # Pending segments and deletions are merged first, since the bounds cover the main postings.
+        if self.segments or self.deleted or self.bounds_generation != self.generation:
+            self.optimize()
+        profile = begin(self.instrumentation, 'search', query)
+        profile.phase('tokenize')
+        sequence = [token for token in self.tokenize(query) if token in self.idf] if k > 0 else []
+        profile.phase('score')
+        counts = defaultdict(int)
+        for token in sequence:
+            counts[token] += 1
+        # Look the postings up once, a loaded index searches its term dictionary on every access
+        postings = {token: self.postings[token] for token in counts}
+        size = self.block_size
+        # A cursor is [last doc of its current block, position, doc ids, tfs, block last, block max,
+        # query multiplicity, number of postings, upper bound, token]; the cursors are kept sorted by
+        # the end of their current block, and a cursor that moves to its next block is put back in place
+        cursors = []
+        for token, count in counts.items():
+            doc_ids, tfs = postings[token]
+            block_last, block_max_scores = self.block_bounds[token]
+            cursors.append([block_last[0], 0, doc_ids, tfs, block_last, block_max_scores,
+                            count, len(doc_ids), count * self.upper_bound[token], token])
+        cursors.sort(key=itemgetter(0))
+        weights = {token: self.idf[token] * (self.k1 + 1) for token in counts}
+        doc_norm = self.doc_norm
+        postings_scored = 0
+        docs_scored = 0
+        blocks_skipped = 0
+        heap_operations = 0
+        # Min-heap of (score, -doc id) holding the current top-k
+        heap = []
+        # Bounds at or below limit cannot beat the k-th score; the slack absorbs rounding differences
+        limit = -math.inf
+        while cursors:
+            stop = cursors[0][0]
+            # Bound the tokens with postings up to stop, smallest bound first
+            present = []
+            bound = 0.0
+            for cursor in cursors:
+                if cursor[2][cursor[1]] <= stop:
+                    token_bound = cursor[6] * cursor[5][cursor[1] // size] if block_max else cursor[8]
+                    present.append((token_bound, cursor))
+                    bound += token_bound
+            present.sort(key=itemgetter(0))
+            # The postings of each present token up to stop, all in its current block
+            ranges = {}
+            for _, cursor in present:
+                start = cursor[1]
+                block_end = min(cursor[7], start // size * size + size)
+                ranges[cursor[9]] = (start, bisect_right(cursor[2], stop, start, block_end))
+            if bound <= limit:
+                blocks_skipped += 1
+            else:
+                # A document in none of the essential tokens scores at most the bounds of the others
+                rest = 0.0
+                essential = 0
+                while essential < len(present) and rest + present[essential][0] <= limit:
+                    rest += present[essential][0]
+                    essential += 1
+                optional = {cursor[9] for _, cursor in present[:essential]}
+                candidates = set()
+                for _, cursor in present[essential:]:
+                    start, end = ranges[cursor[9]]
+                    candidates.update(cursor[2][start:end])
+                # Score the candidates in query order so the result matches search exactly
+                scores = dict.fromkeys(candidates, 0.0)
+                for token in sequence:
+                    if token not in ranges:
+                        continue
+                    weight = weights[token]
+                    doc_ids, tfs = postings[token]
+                    start, end = ranges[token]
+                    if token in optional:
+                        token_tfs = dict(zip(doc_ids[start:end], tfs[start:end]))
+                        for doc_id in scores:
+                            tf = token_tfs.get(doc_id)
+                            if tf is not None:
+                                scores[doc_id] += weight * tf / (tf + doc_norm[doc_id])
+                                postings_scored += 1
+                    else:
+                        for doc_id, tf in zip(doc_ids[start:end], tfs[start:end]):
+                            scores[doc_id] += weight * tf / (tf + doc_norm[doc_id])
+                        postings_scored += end - start
+                docs_scored += len(scores)
+                for doc_id, score in scores.items():
+                    if len(heap) < k:
+                        heapq.heappush(heap, (score, -doc_id))
+                        heap_operations += 1
+                    elif (score, -doc_id) > heap[0]:
+                        heapq.heapreplace(heap, (score, -doc_id))
+                        heap_operations += 1
+                if len(heap) == k:
+                    limit = heap[0][0] - 1e-9 * max(1.0, abs(heap[0][0]))
+            for _, cursor in present:
+                cursor[1] = ranges[cursor[9]][1]
+            # The cursors whose block ends at stop move to their next block or are exhausted
+            while cursors and cursors[0][0] == stop:
+                cursor = cursors.pop(0)
+                if cursor[1] < cursor[7]:
+                    cursor[0] = cursor[4][cursor[1] // size]
+                    insort(cursors, cursor, key=itemgetter(0))
+        if stats is not None:
+            postings_total = sum(len(doc_ids) for doc_ids, _ in postings.values())
+            candidates = set().union(*(doc_ids for doc_ids, _ in postings.values()))
+            stats['postings_total'] = postings_total
+            stats['postings_scored'] = postings_scored
+            stats['postings_skipped'] = postings_total - postings_scored
+            stats['docs_scored'] = docs_scored
+            stats['docs_skipped'] = len(candidates) - docs_scored
+            stats['blocks_skipped'] = blocks_skipped
+        profile.count('postings_read', postings_scored)
+        profile.count('documents_scored', docs_scored)
+        profile.count('blocks_skipped', blocks_skipped)
+        profile.count('heap_operations', heap_operations)
+        # Return the k best scores in descending order, ties broken by document id
+        profile.phase('sort')
+        results = [(-neg_doc_id, score) for score, neg_doc_id in sorted(heap, reverse=True)]
+        profile.finish()
+        return results
+
+    def add_proximity_bonus(self, scores, tokens, proximity):
+        # Add proximity / d^2 to a document for every pair of distinct query tokens whose closest
+        # occurrences in it are d tokens apart
+        if not self.positional:
+            raise ValueError('the proximity bonus needs an index built with positional=True')
+        tokens = [token for token in dict.fromkeys(tokens) if token in self.positions]
+        for doc_id in scores:
+            present = [decode_positions(self.positions[token][doc_id])
+                       for token in tokens if doc_id in self.positions[token]]
+            bonus = 0.0
+            for i in range(len(present)):
+                for j in range(i + 1, len(present)):
+                    bonus += 1 / min_distance(present[i], present[j]) ** 2
+            scores[doc_id] += proximity * bonus
+
+    def save(self, path):
+        # Write the postings, term frequencies and per-document statistics to a binary index file
+        if self.segments or self.deleted or self.bounds_generation != self.generation:
+            self.optimize()
+        tokens = sorted(self.postings)
+        # Save the WAND bounds too, the blocks of every token contiguous, so a loaded index does not
+        # rescore postings to find them
+        upper_bound = array('d')
+        block_last = array('I')
+        block_max = array('d')
+        block_offsets = array('Q', [0])
+        for token in tokens:
+            upper_bound.append(self.upper_bound[token])
+            token_last, token_max = self.block_bounds[token]
+            block_last.extend(token_last)
+            block_max.extend(token_max)
+            block_offsets.append(len(block_last))
+        # Documents that were deleted and purged keep a length of 0
+        write_index(path, ((token, *self.postings[token]) for token in tokens),
+                    arrays={'doc_len': ('I', self.doc_len),
+                            'doc_norm': ('d', self.doc_norm),
+                            'upper_bound': ('d', upper_bound),
+                            'block_last': ('I', block_last),
+                            'block_max': ('d', block_max),
+                            'block_offsets': ('Q', block_offsets)},
+                    metadata={'num_documents': self.num_documents, 'next_doc_id': self.next_doc_id,
+                              'analyzer': self.analyzer.config(),
+                              'avg_dl': self.avg_dl, 'k1': self.k1, 'b': self.b, 'block_size': self.block_size})
+
+    @classmethod
+    def load(cls, path):
+        # Open a saved index without reading the documents; postings and per-token statistics are
+        # read lazily from the memory-mapped file, so loading does not depend on the index size
+        index_file = IndexFile(path)
+        statistics = index_file.statistics
+        ii = cls.__new__(cls)
+        ii.documents = None
+        ii.num_documents = statistics['num_documents']
+        ii.next_doc_id = statistics.get('next_doc_id', ii.num_documents)
+        ii.k1 = statistics['k1']
+        ii.b = statistics['b']
+        ii.block_size = statistics['block_size']
+        ii.avg_dl = statistics['avg_dl']
+        ii.analyzer = Analyzer.from_config(statistics.get('analyzer'))
+        ii.index_file = index_file
+        ii.positional = False
+        ii.positions = {}
+        ii.segments = []
+        ii.deleted = set()
+        ii.merge_thread = None
+        ii.lock = threading.Lock()
+        ii.generation = ii.statistics_generation = ii.bounds_generation = 0
+        ii.cache = QueryCache()
+        ii.instrumentation = None
+        ii.doc_len = index_file.array('doc_len')
+        ii.doc_norm = index_file.array('doc_norm')
+        ii.postings = TermMapping(index_file, lambda i: (index_file.doc_ids(i), index_file.values(i)))
+        ii.idf = TermMapping(index_file, lambda i: ii.idf_from_df(len(index_file.doc_ids(i))))
+        ii.loaded_bounds = {}
+        if 'upper_bound' in index_file.sections:
+            upper_bound = index_file.array('upper_bound')
+            block_last = index_file.array('block_last')
+            block_max = index_file.array('block_max')
+            block_offsets = index_file.array('block_offsets')
+            ii.upper_bound = TermMapping(index_file, upper_bound.__getitem__)
+            ii.block_bounds = TermMapping(index_file, lambda i: (block_last[block_offsets[i]:block_offsets[i + 1]],
+                                                                 block_max[block_offsets[i]:block_offsets[i + 1]]))
+        else:
+            # Files saved without the bounds score the postings of a token once, on its first query
+            ii.upper_bound = TermMapping(index_file, lambda i: ii.token_bounds(i)[0])
+            ii.block_bounds = TermMapping(index_file, lambda i: ii.token_bounds(i)[1])
+        return ii
+
+    def __getstate__(self):
+        # Pickle the index without its lock, merge thread and instrumentation, e.g. to send it to a
+        # worker process; an index loaded from disk cannot be pickled since it reads a memory-mapped file
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+        state = self.__dict__.copy()
+        state['lock'] = state['merge_thread'] = state['instrumentation'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def idf_from_df(self, df):
+        # Calculate the idf of a token contained in df documents
+        return math.log((self.num_documents - df + 0.5) / (df + 0.5))
+
+    def token_bounds(self, position):
+        # Return the score bounds of the token at a position of the loaded index file, calculated once
+        if position not in self.loaded_bounds:
+            doc_ids = self.index_file.doc_ids(position)
+            self.loaded_bounds[position] = self.score_bounds(self.idf_from_df(len(doc_ids)), doc_ids,
+                                                             self.index_file.values(position))
+        return self.loaded_bounds[position]
 
 
 # Usage
 if __name__ == '__main__':
     # Check if the script is being run from the command line
-    if len(sys.argv) != 2:
-        print("Usage: python BM25_ranking.py [file_name]")
+    # Serve queries over the network instead of reading one from the terminal when --serve is given
+    serve_address = None
+    if '--serve' in sys.argv[:-1]:
+        position = sys.argv.index('--serve')
+        serve_address = sys.argv.pop(position + 1)
+        sys.argv.pop(position)
+    # Split the documents over worker processes when --shards is given
+    shards = None
+    if '--shards' in sys.argv[:-1]:
+        position = sys.argv.index('--shards')
+        shards = int(sys.argv.pop(position + 1))
+        sys.argv.pop(position)
+    if len(sys.argv) not in (2, 3) or (shards and len(sys.argv) == 3):
+        print("Usage: python BM25_ranking.py [file_name] [save_index_to] [--serve HOST:PORT|unix:PATH]")
+        print("       python BM25_ranking.py [file_name] --shards N [--serve HOST:PORT|unix:PATH]")
         sys.exit(1)
 
     # Get the filename from the command-line argument
     filename = sys.argv[1]
 
-    # Read the documents from the file
-    documents = []
+    if shards:
+        # Search shards of the file in worker processes that score with the global statistics
+        ii = ShardedIndex(filename, shards, open_shard)
+    elif is_index_file(filename):
+        # Open a previously saved index
+        ii = InvertedIndex.load(filename)
+    else:
+        # Read the documents from the file
+        documents = []
+
+        with open(filename, encoding="utf8") as file:
+            for line in file:
+                documents.append(line.strip())
+
+        # Create an instance of the InvertedIndex class
+        ii = InvertedIndex(documents)
 
-    with open(filename, encoding="utf8") as file:
-        for line in file:
-            documents.append(line.strip())
+    # Save the index when a second file name is given
+    if len(sys.argv) == 3:
+        ii.save(sys.argv[2])
 
-    # Create an instance of the InvertedIndex class
-    ii = InvertedIndex(documents)
+    # Answer line-delimited JSON requests until interrupted
+    if serve_address is not None:
+        serve(ii, serve_address)
+        sys.exit(0)
 
     # Prompt the user to enter a query
     query = input('Search: ')
 
     # Search for the query and get the top 10 results
-    results = ii.search(query)
+    results = ii.search(query, k=10)
     print("Results for query '%s':" % query)
-    for doc_id, score in results[0: 11]:
+    for doc_id, score in results:
         print("Doc %d: score: %.5f" % (doc_id, score))
@@ -0,0 +1,7 @@
+""" Synthetic corpora, query logs and a benchmark runner for the index and ranking engines.
+
+    python -m benchmark.generate corpus OUT [--documents N] [--vocabulary V] [--zipf S] [--length L]
+    python -m benchmark.generate queries OUT [--queries N] [--distinct D] [--head H] [--head-fraction F]
+    python -m benchmark.runner [--corpus FILE] [--query-log FILE] [--engines ...] [--output results.json]
+    python -m benchmark.compare baseline.json results.json [--threshold 0.1]
+"""
@@ -0,0 +1,67 @@
+""" Compare two benchmark reports and flag the metrics that got worse by more than a threshold.
+
+    python -m benchmark.compare baseline.json results.json [--threshold 0.1]
+
+Exits with status 1 when a regression is found, so it can gate a CI job.
+"""
+
+import argparse
+import json
+import sys
+
+# Metrics where a smaller value is better, and those where a larger one is
+LOWER_IS_BETTER = ('build_seconds', 'peak_rss_bytes', 'index_bytes', 'latency_ms.p50', 'latency_ms.p95',
+                   'latency_ms.p99')
+HIGHER_IS_BETTER = ('qps',)
+
+
+def metric(measurements, name):
+    for part in name.split('.'):
+        measurements = measurements.get(part) if isinstance(measurements, dict) else None
+    return measurements
+
+
+def compare(baseline, current, threshold=0.1):
+    """ Return (engine, metric, baseline value, current value, relative change, regressed) rows.
+
+    >>> old = {'engines': {'BM25_ranking': {'qps': 100.0, 'latency_ms': {'p50': 2.0}}}}
+    >>> new = {'engines': {'BM25_ranking': {'qps': 80.0, 'latency_ms': {'p50': 2.1}}}}
+    >>> [(row[1], round(row[4], 2), row[5]) for row in compare(old, new)]
+    [('latency_ms.p50', 0.05, False), ('qps', -0.2, True)]
+    """
+    rows = []
+    for engine, measurements in current['engines'].items():
+        old_measurements = baseline['engines'].get(engine)
+        if old_measurements is None:
+            continue
+        for name in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            old = metric(old_measurements, name)
+            new = metric(measurements, name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = change > threshold if name in LOWER_IS_BETTER else change < -threshold
+            rows.append((engine, name, old, new, change, regressed))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports.')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    args = parser.parse_args(argv)
+    with open(args.baseline, encoding="utf8") as file:
+        baseline = json.load(file)
+    with open(args.current, encoding="utf8") as file:
+        current = json.load(file)
+    rows = compare(baseline, current, args.threshold)
+    for engine, name, old, new, change, regressed in rows:
+        print('%-24s %-16s %14.4g %14.4g %+8.1f%% %s' % (engine, name, old, new, 100 * change,
+                                                         'REGRESSION' if regressed else ''))
+    if any(row[5] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
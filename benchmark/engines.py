@@ -0,0 +1,133 @@
+""" Uniform adapters around the engine scripts for the benchmark runner.
+
+The engines live in script directories whose names are not importable, so
+they are loaded from their file paths. Every adapter builds an index from a
+corpus file, answers a query with at most k results, and reports the size of
+the index in bytes when the engine has a compact form to measure.
+"""
+
+import importlib.util
+import os
+import sys
+
+from common.analysis import Analyzer
+from common.cache import QueryCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENGINE_FILES = {
+    'inverted_index': os.path.join('inverted index', 'inverted_index.py'),
+    'compress_inverted_index': os.path.join('compress_inverted_index', 'compress_inverted_index.py'),
+    'BM25_ranking': os.path.join('BM25 ranking', 'BM25_ranking.py'),
+    'tf-idf_ranking': os.path.join('tf-idf ranking', 'tf-idf_ranking.py'),
+    'tf-idf-cosine_ranking': os.path.join('tf-idf-cosine ranking', 'tf-idf-cosine_ranking.py'),
+}
+
+
+def load_module(name):
+    """ Import an engine script by name. """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, ENGINE_FILES[name]))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_documents(path):
+    with open(path, encoding="utf8") as file:
+        return [line.strip() for line in file]
+
+
+def saved_size(index, directory):
+    """ Save index into directory and return the size of the file. """
+    path = os.path.join(directory, 'index.idx')
+    index.save(path)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
+
+
+class Engine:
+    """ Build, query and measure one engine; subclasses fill in the engine-specific parts. """
+
+    module = None
+
+    def build(self, corpus_path):
+        raise NotImplementedError
+
+    def search(self, index, query, k):
+        raise NotImplementedError
+
+    def index_bytes(self, index, directory):
+        return saved_size(index, directory)
+
+    def disable_cache(self, index):
+        """ Replace the query caches of an index by empty ones so every query is computed. """
+        if hasattr(index, 'cache'):
+            index.cache = QueryCache(0, 0)
+
+
+class InvertedIndexEngine(Engine):
+    module = 'inverted_index'
+
+    def build(self, corpus_path):
+        index = load_module(self.module).InvertedIndex()
+        index.read_from_txt(corpus_path)
+        return index
+
+    def search(self, index, query, k):
+        return sorted(index.search(query))[:k]
+
+
+class CompressedIndexEngine(InvertedIndexEngine):
+    module = 'compress_inverted_index'
+
+    def build(self, corpus_path):
+        index = super().build(corpus_path)
+        index.compress()
+        return index
+
+    def index_bytes(self, index, directory):
+        # The compressed dictionary and postings only exist in memory
+        return (len(index.indexes.encode('utf8')) + index.indexOffsets.itemsize * len(index.indexOffsets)
+                + sum(postings.size_in_bytes() for postings in index.postings))
+
+
+class BM25Engine(Engine):
+    module = 'BM25_ranking'
+
+    def build(self, corpus_path):
+        return load_module(self.module).InvertedIndex(read_documents(corpus_path))
+
+    def search(self, index, query, k):
+        return index.search(query, k)
+
+
+class CosineEngine(BM25Engine):
+    module = 'tf-idf-cosine_ranking'
+
+
+class TfIdfEngine(Engine):
+    module = 'tf-idf_ranking'
+    # The engine indexes lists of terms, so the adapter does the tokenizing
+    analyzer = Analyzer()
+
+    def build(self, corpus_path):
+        index = load_module(self.module).InvertedIndex()
+        for doc_id, document in enumerate(read_documents(corpus_path)):
+            index.add_document(doc_id, self.analyzer.tokens(document))
+        index.calculate_idf()
+        return index
+
+    def search(self, index, query, k):
+        return index.rank_documents(self.analyzer.tokens(query))[:k]
+
+    def index_bytes(self, index, directory):
+        # The engine has no on-disk format
+        return None
+
+
+ENGINES = {engine.module: engine for engine in (InvertedIndexEngine(), CompressedIndexEngine(), BM25Engine(),
+                                                 TfIdfEngine(), CosineEngine())}
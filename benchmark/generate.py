@@ -0,0 +1,115 @@
+""" Generate a synthetic corpus with Zipf-distributed words and a query log with head and tail terms.
+
+Word ranks are spelled as letter strings ('a', 'b', ..., 'z', 'ba', ...), so every
+word survives the shared analyzer unchanged. The word of rank r (counting from 1)
+is drawn with probability proportional to 1 / r ** zipf. A corpus file has one
+document per line and a query log has one query per line, like the Datasets files.
+"""
+
+import argparse
+import bisect
+import itertools
+import random
+import string
+
+
+def word(rank):
+    """ Spell a 0-based word rank with lowercase letters.
+
+    >>> [word(rank) for rank in (0, 1, 25, 26, 27, 700)]
+    ['a', 'b', 'z', 'ba', 'bb', 'bay']
+    """
+    letters = []
+    while True:
+        rank, digit = divmod(rank, 26)
+        letters.append(string.ascii_lowercase[digit])
+        if not rank:
+            return ''.join(reversed(letters))
+
+
+def zipf_weights(size, skew):
+    """ Return the cumulative Zipf weights of ranks 1..size. """
+    return list(itertools.accumulate(1 / rank ** skew for rank in range(1, size + 1)))
+
+
+def generate_corpus(documents=10000, vocabulary=50000, zipf=1.1, length=100, seed=0):
+    """ Yield documents of about length words drawn from a Zipfian vocabulary.
+
+    Document lengths are uniform between length / 2 and 3 * length / 2.
+
+    >>> corpus = list(generate_corpus(documents=3, vocabulary=10, length=4, seed=1))
+    >>> len(corpus), all(set(document) <= set(string.ascii_lowercase + ' ') for document in corpus)
+    (3, True)
+    """
+    rng = random.Random(seed)
+    words = [word(rank) for rank in range(vocabulary)]
+    weights = zipf_weights(vocabulary, zipf)
+    for _ in range(documents):
+        size = rng.randint(max(1, length // 2), max(1, length * 3 // 2))
+        yield ' '.join(rng.choices(words, cum_weights=weights, k=size))
+
+
+def generate_queries(queries=1000, distinct=200, vocabulary=50000, head=100, head_fraction=0.7,
+                     max_terms=4, zipf=1.0, seed=0):
+    """ Yield a query log drawn from a pool of distinct queries.
+
+    Every query term comes from the head (the head most frequent corpus words)
+    with probability head_fraction, and otherwise from the tail, uniformly. How
+    often each pool query repeats in the log is Zipf-distributed with skew zipf,
+    so the log has hot queries the way real traffic does.
+
+    >>> log = list(generate_queries(queries=20, distinct=5, vocabulary=1000, head=10, seed=1))
+    >>> len(log), len(set(log)) <= 5
+    (20, True)
+    """
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(distinct):
+        terms = []
+        for _ in range(rng.randint(1, max_terms)):
+            if rng.random() < head_fraction or head >= vocabulary:
+                terms.append(word(rng.randrange(min(head, vocabulary))))
+            else:
+                terms.append(word(rng.randrange(head, vocabulary)))
+        pool.append(' '.join(terms))
+    weights = zipf_weights(distinct, zipf)
+    for _ in range(queries):
+        yield pool[bisect.bisect_left(weights, rng.random() * weights[-1])]
+
+
+def write_lines(path, lines):
+    with open(path, 'w', encoding="utf8") as file:
+        for line in lines:
+            file.write(line + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic corpus or query log.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    corpus = commands.add_parser('corpus')
+    corpus.add_argument('output')
+    corpus.add_argument('--documents', type=int, default=10000)
+    corpus.add_argument('--vocabulary', type=int, default=50000)
+    corpus.add_argument('--zipf', type=float, default=1.1)
+    corpus.add_argument('--length', type=int, default=100)
+    corpus.add_argument('--seed', type=int, default=0)
+    queries = commands.add_parser('queries')
+    queries.add_argument('output')
+    queries.add_argument('--queries', type=int, default=1000)
+    queries.add_argument('--distinct', type=int, default=200)
+    queries.add_argument('--vocabulary', type=int, default=50000)
+    queries.add_argument('--head', type=int, default=100)
+    queries.add_argument('--head-fraction', type=float, default=0.7)
+    queries.add_argument('--max-terms', type=int, default=4)
+    queries.add_argument('--zipf', type=float, default=1.0)
+    queries.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.command == 'corpus':
+        write_lines(args.output, generate_corpus(args.documents, args.vocabulary, args.zipf, args.length, args.seed))
+    else:
+        write_lines(args.output, generate_queries(args.queries, args.distinct, args.vocabulary, args.head,
+                                                  args.head_fraction, args.max_terms, args.zipf, args.seed))
+
+
+if __name__ == '__main__':
+    main()
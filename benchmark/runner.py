@@ -0,0 +1,138 @@
+""" Measure build time, peak memory, index size and query latency of the engines and write JSON.
+
+Every engine runs in a fresh process, so its peak resident set size is its
+own. When no corpus or query log is given, they are generated into a
+temporary directory from the generator options.
+
+    python -m benchmark.runner --documents 20000 --queries 2000 --output results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from benchmark.engines import ENGINES
+from benchmark.generate import generate_corpus, generate_queries, write_lines
+from common.loadgen import percentile
+
+try:
+    import resource
+except ImportError:  # peak memory is not reported without the resource module
+    resource = None
+
+
+def peak_rss():
+    """ Return the peak resident set size of this process in bytes, or None when unknown. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure(name, corpus_path, queries, k=10, cache=True):
+    """ Build one engine over corpus_path, run queries and return its measurements. """
+    engine = ENGINES[name]
+    rss_before = peak_rss()
+    start = time.perf_counter()
+    index = engine.build(corpus_path)
+    build_seconds = time.perf_counter() - start
+    rss_after_build = peak_rss()
+    with tempfile.TemporaryDirectory() as directory:
+        index_bytes = engine.index_bytes(index, directory)
+    if not cache:
+        engine.disable_cache(index)
+
+    latencies = []
+    results = 0
+    start = time.perf_counter()
+    for query in queries:
+        query_start = time.perf_counter()
+        results += len(engine.search(index, query, k))
+        latencies.append(time.perf_counter() - query_start)
+    query_seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'build_seconds': build_seconds,
+        'peak_rss_bytes': peak_rss(),
+        'build_rss_bytes': rss_after_build - rss_before if rss_before is not None else None,
+        'index_bytes': index_bytes,
+        'queries': len(queries),
+        'results': results,
+        'query_seconds': query_seconds,
+        'qps': len(queries) / query_seconds if query_seconds else 0.0,
+        'latency_ms': {label: 1000 * percentile(latencies, fraction)
+                       for label, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+    }
+
+
+def run(corpus_path, query_path, engines=None, k=10, cache=True):
+    """ Measure every engine in its own process and return the report dictionary. """
+    with open(query_path, encoding="utf8") as file:
+        queries = [line.strip() for line in file if line.strip()]
+    report = {
+        'config': {'corpus': corpus_path, 'corpus_bytes': os.path.getsize(corpus_path),
+                   'queries': query_path, 'k': k, 'cache': cache},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()},
+        'engines': {},
+    }
+    for name in engines or ENGINES:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+            report['engines'][name] = executor.submit(measure, name, corpus_path, queries, k, cache).result()
+        print('%s done' % name, file=sys.stderr)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the index and ranking engines.')
+    parser.add_argument('--corpus', help='corpus file, one document per line (generated when omitted)')
+    parser.add_argument('--query-log', help='query file, one query per line (generated when omitted)')
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), help='engines to run (default: all)')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--no-cache', action='store_true', help='disable the query result caches')
+    parser.add_argument('--output', help='write the JSON report here instead of to standard output')
+    parser.add_argument('--documents', type=int, default=10000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--length', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--distinct', type=int, default=200)
+    parser.add_argument('--head', type=int, default=100)
+    parser.add_argument('--head-fraction', type=float, default=0.7)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        corpus_path = args.corpus
+        if corpus_path is None:
+            corpus_path = os.path.join(directory, 'corpus.txt')
+            write_lines(corpus_path, generate_corpus(args.documents, args.vocabulary, args.zipf, args.length,
+                                                     args.seed))
+        query_path = args.query_log
+        if query_path is None:
+            query_path = os.path.join(directory, 'queries.txt')
+            write_lines(query_path, generate_queries(args.queries, args.distinct, args.vocabulary, args.head,
+                                                     args.head_fraction, seed=args.seed))
+        report = run(corpus_path, query_path, args.engines, args.k, not args.no_cache)
+        if args.corpus is None or args.query_log is None:
+            report['config']['generator'] = {name: getattr(args, name) for name in
+                                             ('documents', 'vocabulary', 'zipf', 'length', 'queries', 'distinct',
+                                              'head', 'head_fraction', 'seed')}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding="utf8") as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
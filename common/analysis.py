@@ -0,0 +1,126 @@
+""" Turn text into index terms, shared by every index and ranking module.
+
+A token is a maximal run of the ASCII letters a-z after lowercasing, found by
+one compiled regular expression, so separators never produce empty tokens.
+Optional stages drop stopwords and strip plural suffixes. A Vocabulary interns
+the resulting terms to dense integer ids, so that per-document structures can
+be stored as integer arrays instead of lists of strings.
+"""
+
+import re
+from array import array
+
+TOKEN = re.compile('[a-z]+')
+
+# The English stopword list of Lucene's StandardAnalyzer
+ENGLISH_STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in', 'into', 'is', 'it',
+    'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the', 'their', 'then', 'there', 'these',
+    'they', 'this', 'to', 'was', 'will', 'with'))
+
+
+def s_stem(word):
+    """ Strip English plural endings with the S-stemmer of Harman (1991).
+
+    >>> [s_stem(word) for word in ['queries', 'indexes', 'documents', 'corpus', 'glass', 'toes']]
+    ['query', 'indexe', 'document', 'corpus', 'glass', 'toe']
+    """
+    if word.endswith('ies') and not word.endswith(('eies', 'aies')):
+        return word[:-3] + 'y'
+    if word.endswith('es') and not word.endswith(('aes', 'ees', 'oes')):
+        return word[:-1]
+    if word.endswith('s') and not word.endswith(('us', 'ss')):
+        return word[:-1]
+    return word
+
+
+class Analyzer:
+    """ Split text into lowercase letter tokens, optionally removing stopwords and stemming.
+
+    >>> Analyzer().tokens('The first_document, [second]  DOCUMENT 3rd')
+    ['the', 'first', 'document', 'second', 'document', 'rd']
+    >>> Analyzer(stopwords=ENGLISH_STOPWORDS, stem=True).tokens('The documents of the queries')
+    ['document', 'query']
+    >>> Analyzer().tokens('')
+    []
+    """
+
+    def __init__(self, stopwords=None, stem=False):
+        self.stopwords = frozenset(stopwords or ())
+        self.stem = stem
+        self._stems = {}
+
+    def tokens(self, text):
+        """ Return the terms of text in order. """
+        tokens = TOKEN.findall(text.lower())
+        if self.stopwords:
+            stopwords = self.stopwords
+            tokens = [token for token in tokens if token not in stopwords]
+        if self.stem:
+            stems = self._stems
+            for position, token in enumerate(tokens):
+                stem = stems.get(token)
+                if stem is None:
+                    stem = stems[token] = s_stem(token)
+                tokens[position] = stem
+        return tokens
+
+    def term_ids(self, text, vocabulary):
+        """ Return the terms of text as an array of vocabulary ids, adding new terms. """
+        return vocabulary.intern(self.tokens(text))
+
+    def config(self):
+        """ Return the settings as a JSON-serializable dictionary for saved indexes. """
+        return {'stopwords': sorted(self.stopwords), 'stem': self.stem}
+
+    @classmethod
+    def from_config(cls, config):
+        """ Recreate the analyzer described by config; None gives the default analyzer. """
+        return cls(**config) if config else cls()
+
+    def __eq__(self, other):
+        return isinstance(other, Analyzer) and self.config() == other.config()
+
+    def __repr__(self):
+        return 'Analyzer(stopwords=%d words, stem=%r)' % (len(self.stopwords), self.stem)
+
+
+class Vocabulary:
+    """ Intern terms to dense integer ids in order of first appearance.
+
+    >>> vocabulary = Vocabulary()
+    >>> list(vocabulary.intern(['second', 'document', 'second']))
+    [0, 1, 0]
+    >>> vocabulary.get('document'), vocabulary.get('third'), vocabulary.terms[0], len(vocabulary)
+    (1, None, 'second', 2)
+    """
+
+    def __init__(self, terms=()):
+        self.ids = {}
+        self.terms = []
+        for term in terms:
+            self.add(term)
+
+    def add(self, term):
+        """ Return the id of term, assigning the next id to a new term. """
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def get(self, term, default=None):
+        """ Return the id of term, or default for an unknown term. """
+        return self.ids.get(term, default)
+
+    def intern(self, tokens):
+        """ Return the ids of tokens as an unsigned int array, adding new terms. """
+        ids = self.ids
+        add = self.add
+        return array('I', [ids[token] if token in ids else add(token) for token in tokens])
+
+    def __contains__(self, term):
+        return term in self.ids
+
+    def __len__(self):
+        return len(self.terms)
@@ -0,0 +1,339 @@
+""" Compressed sets of document ids in the style of Roaring bitmaps.
+
+Document ids are split into chunks of 65536 by their high 16 bits. A chunk
+holding at most ARRAY_LIMIT ids is stored as a sorted array('H') of the low
+16 bits, two bytes per id; a fuller chunk as a bitmap, a Python int with one
+bit per low id, which never takes more than 8 KB. Rare terms therefore cost
+about two bytes per posting and frequent terms a fraction of a byte.
+
+AND, OR and AND NOT combine the chunks with the same high bits:
+
+    - two bitmaps with the integer operators &, | and & ~
+    - two arrays with set operations, or by binary searching every id of
+      the shorter array in the longer one when their lengths are very different
+    - an array and a bitmap by selecting the array ids whose bit is set:
+      a short array probes the bits of the bitmap one shift per id, a long
+      one reads them from the bitmap spelled out as bytes
+
+so no operation loops over document ids in Python code, and an operation
+involving a short array costs in proportion to the array, not to the chunk.
+"""
+
+import itertools
+import struct
+from collections import deque
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import partial
+from operator import sub
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+LOW_MASK = CHUNK_SIZE - 1
+# Beyond 4096 ids an array takes more than the 8 KB of a bitmap
+ARRAY_LIMIT = 4096
+BITMAP_BYTES = CHUNK_SIZE // 8
+# Below this many ids an array is tested against a bitmap bit by bit; above
+# it spelling out the 65536 flags of the bitmap once is cheaper
+PROBE_LIMIT = 128
+# Intersect two arrays by binary search when one is this many times longer than the other
+GALLOP_RATIO = 8
+
+ARRAY, BITMAP = 0, 1
+# Serialized layout: chunk count, then per chunk its high bits, kind and
+# number of ids followed by the little-endian array or bitmap
+HEADER = struct.Struct('<I')
+CONTAINER = struct.Struct('<HBI')
+
+_LOWS = range(CHUNK_SIZE)
+_DIGITS_TO_FLAGS = bytes.maketrans(b'01', b'\x00\x01')
+_FLAGS_TO_DIGITS = bytes.maketrans(b'\x00\x01', b'01')
+_LITTLE_ENDIAN = array('H', [1]).tobytes() == b'\x01\x00'
+
+
+def _flags(bits):
+    """ Spell a chunk bitmap as 65536 bytes, 1 where the low id is set. """
+    return format(bits, '065536b').encode('ascii')[::-1].translate(_DIGITS_TO_FLAGS)
+
+
+def _to_array(bits):
+    return array('H', itertools.compress(_LOWS, _flags(bits)))
+
+
+def _to_bitmap(lows):
+    """ Turn a sorted array of distinct low ids into a chunk bitmap. """
+    if len(lows) < PROBE_LIMIT:
+        return sum(map((1).__lshift__, lows))
+    flags = bytearray(CHUNK_SIZE)
+    deque(map(flags.__setitem__, lows, itertools.repeat(1)), maxlen=0)
+    return int(flags[::-1].translate(_FLAGS_TO_DIGITS), 2)
+
+
+def _select(lows, bits, keep=True):
+    """ The ids of the array lows whose bit in bits is set, or clear when not keep. """
+    if len(lows) < PROBE_LIMIT:
+        tests = map((1).__and__, map(bits.__rshift__, lows))
+    else:
+        flags = _flags(bits)
+        tests = map(flags.__getitem__, lows)
+    if not keep:
+        tests = map((1).__xor__, tests)
+    return array('H', itertools.compress(lows, tests))
+
+
+def _cardinality(container):
+    return container.bit_count() if isinstance(container, int) else len(container)
+
+
+def _optimize(container):
+    """ Pick the smaller representation of a chunk; None when it is empty. """
+    if isinstance(container, int):
+        count = container.bit_count()
+        if not count:
+            return None
+        return _to_array(container) if count <= ARRAY_LIMIT else container
+    if not container:
+        return None
+    return _to_bitmap(container) if len(container) > ARRAY_LIMIT else container
+
+
+def _and(left, right):
+    if isinstance(left, int) and isinstance(right, int):
+        return left & right
+    if isinstance(left, int):
+        left, right = right, left
+    if isinstance(right, int):
+        return _select(left, right)
+    if len(left) > len(right):
+        left, right = right, left
+    if len(left) * GALLOP_RATIO < len(right):
+        # An id of left is in right when the insertion points before and after it differ
+        found = map(sub, map(partial(bisect_right, right), left), map(partial(bisect_left, right), left))
+        return array('H', itertools.compress(left, found))
+    return array('H', sorted(set(left).intersection(right)))
+
+
+def _or(left, right):
+    if isinstance(left, int) or isinstance(right, int):
+        left = left if isinstance(left, int) else _to_bitmap(left)
+        right = right if isinstance(right, int) else _to_bitmap(right)
+        return left | right
+    return array('H', sorted(set(left).union(right)))
+
+
+def _and_not(left, right):
+    if isinstance(left, int):
+        return left & ~(right if isinstance(right, int) else _to_bitmap(right))
+    if isinstance(right, int):
+        return _select(left, right, keep=False)
+    return array('H', sorted(set(left).difference(right)))
+
+
+class RoaringBitmap:
+    """ A set of document ids stored as one array or bitmap container per chunk of 65536 ids.
+
+    >>> dense = RoaringBitmap(range(0, 20000, 2))
+    >>> sparse = RoaringBitmap([4, 5, 70000, 70001])
+    >>> dense & sparse
+    RoaringBitmap([4])
+    >>> len(dense | sparse), len(dense - sparse)
+    (10003, 9999)
+    >>> [type(container).__name__ for container in (dense | sparse).containers]
+    ['int', 'array']
+    >>> RoaringBitmap.from_bytes(sparse.to_bytes()) == sparse
+    True
+    """
+
+    __slots__ = ('keys', 'containers')
+
+    def __init__(self, doc_ids=()):
+        self.keys = []
+        self.containers = []
+        doc_ids = sorted(set(doc_ids))
+        start = 0
+        while start < len(doc_ids):
+            # The ids of a chunk are found by binary search rather than grouped one by one
+            key = doc_ids[start] >> CHUNK_BITS
+            end = bisect_left(doc_ids, (key + 1) << CHUNK_BITS, start)
+            lows = doc_ids[start:end] if key == 0 else map(LOW_MASK.__and__, doc_ids[start:end])
+            self.keys.append(key)
+            self.containers.append(_optimize(array('H', lows)))
+            start = end
+
+    def add(self, doc_id):
+        """ Add doc_id, which must not be smaller than any id added before; call optimize when done.
+
+        The last chunk grows as an array, so adding stays cheap while an index
+        is built in document order.
+
+        >>> postings = RoaringBitmap()
+        >>> for doc_id in (3, 3, 9, 65536):
+        ...     postings.add(doc_id)
+        >>> postings
+        RoaringBitmap([3, 9, 65536])
+        """
+        key = doc_id >> CHUNK_BITS
+        low = doc_id & LOW_MASK
+        if not self.keys or self.keys[-1] < key:
+            self.optimize()
+            self.keys.append(key)
+            self.containers.append(array('H', (low,)))
+            return
+        container = self.containers[-1]
+        if self.keys[-1] > key:
+            raise ValueError('document ids must be added in increasing order')
+        if isinstance(container, int):
+            self.containers[-1] = container | 1 << low
+        elif container[-1] < low:
+            container.append(low)
+        elif container[-1] > low:
+            raise ValueError('document ids must be added in increasing order')
+
+    def optimize(self):
+        """ Store the last chunk as a bitmap when it has outgrown an array. """
+        if self.containers:
+            self.containers[-1] = _optimize(self.containers[-1])
+
+    def _merge(self, other, operation, keep_left, keep_right):
+        """ Combine the chunks both bitmaps have; chunks of one side only are kept when keep_left/keep_right. """
+        result = RoaringBitmap()
+        left = dict(zip(self.keys, self.containers))
+        right = dict(zip(other.keys, other.containers))
+        for key in sorted(left.keys() | right.keys()):
+            if key in left and key in right:
+                container = _optimize(operation(left[key], right[key]))
+            elif key in left:
+                container = left[key] if keep_left else None
+            else:
+                container = right[key] if keep_right else None
+            if container is not None:
+                result.keys.append(key)
+                result.containers.append(container)
+        return result
+
+    def __and__(self, other):
+        return self._merge(other, _and, False, False)
+
+    def __or__(self, other):
+        return self._merge(other, _or, True, True)
+
+    def __sub__(self, other):
+        return self._merge(other, _and_not, True, False)
+
+    def __len__(self):
+        return sum(map(_cardinality, self.containers))
+
+    def __iter__(self):
+        for key, container in zip(self.keys, self.containers):
+            lows = _to_array(container) if isinstance(container, int) else container
+            yield from map((key << CHUNK_BITS).__add__, lows)
+
+    def __contains__(self, doc_id):
+        key = doc_id >> CHUNK_BITS
+        low = doc_id & LOW_MASK
+        chunk = bisect_left(self.keys, key)
+        if chunk == len(self.keys) or self.keys[chunk] != key:
+            return False
+        container = self.containers[chunk]
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+    def __eq__(self, other):
+        if not isinstance(other, RoaringBitmap):
+            return NotImplemented
+        return self.keys == other.keys and list(self) == list(other)
+
+    def __repr__(self):
+        return 'RoaringBitmap(%r)' % list(self)
+
+    def cursor(self):
+        return RoaringCursor(self)
+
+    def size_in_bytes(self):
+        """ Size of the serialized bitmap. """
+        return HEADER.size + sum(CONTAINER.size + (BITMAP_BYTES if isinstance(container, int) else 2 * len(container))
+                                 for container in self.containers)
+
+    def to_bytes(self):
+        parts = [HEADER.pack(len(self.keys))]
+        for key, container in zip(self.keys, self.containers):
+            if isinstance(container, int):
+                parts.append(CONTAINER.pack(key, BITMAP, container.bit_count()))
+                parts.append(container.to_bytes(BITMAP_BYTES, 'little'))
+            else:
+                parts.append(CONTAINER.pack(key, ARRAY, len(container)))
+                if not _LITTLE_ENDIAN:
+                    container = array('H', container)
+                    container.byteswap()
+                parts.append(container.tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        bitmap = cls()
+        (count,) = HEADER.unpack_from(data)
+        offset = HEADER.size
+        for _ in range(count):
+            key, kind, cardinality = CONTAINER.unpack_from(data, offset)
+            offset += CONTAINER.size
+            if kind == BITMAP:
+                container = int.from_bytes(data[offset:offset + BITMAP_BYTES], 'little')
+                offset += BITMAP_BYTES
+            else:
+                container = array('H')
+                container.frombytes(data[offset:offset + 2 * cardinality])
+                if not _LITTLE_ENDIAN:
+                    container.byteswap()
+                offset += 2 * cardinality
+            bitmap.keys.append(key)
+            bitmap.containers.append(container)
+        return bitmap
+
+
+class RoaringCursor:
+    """ Cursor over a RoaringBitmap for the Boolean query evaluator.
+
+    >>> cursor = RoaringBitmap([2, 7, 70000] + list(range(131072, 140000))).cursor()
+    >>> cursor.next_geq(3), cursor.next_geq(8), cursor.next_geq(131073), cursor.next_geq(140000)
+    (7, 70000, 131073, None)
+    """
+
+    def __init__(self, bitmap):
+        self.bitmap = bitmap
+        self.chunk = 0
+        # Bytes spelling of the current chunk when it is a bitmap, searched with find
+        self.flags = None
+        # Last id returned, None once the cursor is exhausted; like ListCursor it never moves back
+        self.current = -1
+
+    def next_geq(self, target):
+        if self.current is None or self.current >= target:
+            return self.current
+        self.current = self._seek(target)
+        return self.current
+
+    def _seek(self, target):
+        keys = self.bitmap.keys
+        containers = self.bitmap.containers
+        key = target >> CHUNK_BITS
+        chunk = bisect_left(keys, key, self.chunk)
+        while chunk < len(keys):
+            if chunk != self.chunk:
+                self.chunk = chunk
+                self.flags = None
+            low = target & LOW_MASK if keys[chunk] == key else 0
+            container = containers[chunk]
+            if isinstance(container, int):
+                if self.flags is None:
+                    self.flags = _flags(container)
+                position = self.flags.find(1, low)
+                if position >= 0:
+                    return (keys[chunk] << CHUNK_BITS) + position
+            else:
+                position = bisect_left(container, low)
+                if position < len(container):
+                    return (keys[chunk] << CHUNK_BITS) + container[position]
+            chunk += 1
+        return None
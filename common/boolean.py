@@ -0,0 +1,358 @@
+""" Boolean queries with AND, OR, NOT and parentheses, planned with document frequencies.
+
+A query is parsed into a tree of Term, And, Or and Not nodes. NOT binds
+tighter than AND, and AND binds tighter than OR. Words next to each other are
+ANDed, so a plain list of words still means all of them. Operators must be
+written in capitals; lowercase 'and', 'or' and 'not' are searched as words.
+
+plan rewrites the tree using the document frequency of every word:
+
+    - nested ANDs and ORs are flattened and repeated operands removed
+    - an AND with a word no document contains matches nothing, and such
+      words are dropped from ORs and from the subtracted side of a NOT
+    - the operands of an AND are ordered from the smallest to the largest,
+      so the rarest list drives the intersection
+    - NOT is pushed down into the AND it belongs to as a Difference: the
+      candidates of the positive operands are checked against the negated
+      lists, which are never enumerated
+
+evaluate turns a plan into cursors over sorted document ids and yields the
+matches in increasing order. A cursor only has next_geq(target), which returns
+the first id >= target or None, so an AND leapfrogs its lists, an OR merges
+them with a heap, and no intermediate result is materialized.
+"""
+
+import heapq
+import re
+from bisect import bisect_left
+
+QUERY_TOKEN = re.compile(r'[()]|[^\s()]+')
+OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class Term:
+    def __init__(self, word):
+        self.word = word
+        self.size = None
+
+    def __repr__(self):
+        return 'Term(%r)' % self.word
+
+
+class And:
+    def __init__(self, children):
+        self.children = list(children)
+        self.size = None
+
+    def __repr__(self):
+        return 'And(%s)' % ', '.join(map(repr, self.children))
+
+
+class Or:
+    def __init__(self, children):
+        self.children = list(children)
+        self.size = None
+
+    def __repr__(self):
+        return 'Or(%s)' % ', '.join(map(repr, self.children))
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return 'Not(%r)' % self.child
+
+
+class Difference:
+    """ The documents of positive that are in none of the negative plans. """
+
+    def __init__(self, positive, negatives):
+        self.positive = positive
+        self.negatives = list(negatives)
+        self.size = positive.size
+
+    def __repr__(self):
+        return 'Difference(%r, %s)' % (self.positive, ', '.join(map(repr, self.negatives)))
+
+
+class Empty:
+    """ A plan that matches no document. """
+
+    size = 0
+
+    def __repr__(self):
+        return 'Empty()'
+
+
+def parse(query, analyzer):
+    """ Parse a Boolean query; every word is passed through the analyzer.
+
+    A word the analyzer splits becomes an AND of its parts and a word it drops
+    (a stopword or punctuation) is left out. Returns None for a query without
+    words.
+
+    >>> from common.analysis import Analyzer
+    >>> parse('first document OR NOT (Second OR third)', Analyzer())
+    Or(And(Term('first'), Term('document')), Not(Or(Term('second'), Term('third'))))
+    >>> parse('(first', Analyzer())
+    Traceback (most recent call last):
+    ...
+    ValueError: missing ')' in query
+    """
+    tokens = QUERY_TOKEN.findall(query)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        children = [parse_and()]
+        while peek() == 'OR':
+            position += 1
+            children.append(parse_and())
+        children = [child for child in children if child is not None]
+        return children[0] if len(children) == 1 else (Or(children) if children else None)
+
+    def parse_and():
+        nonlocal position
+        children = [parse_not()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                position += 1
+            children.append(parse_not())
+        children = [child for child in children if child is not None]
+        return children[0] if len(children) == 1 else (And(children) if children else None)
+
+    def parse_not():
+        nonlocal position
+        if peek() == 'NOT':
+            position += 1
+            child = parse_not()
+            return Not(child) if child is not None else None
+        return parse_operand()
+
+    def parse_operand():
+        nonlocal position
+        token = peek()
+        if token is None or token in OPERATORS or token == ')':
+            raise ValueError('expected a word or ( at position %d of query' % position)
+        position += 1
+        if token == '(':
+            child = parse_or()
+            if peek() != ')':
+                raise ValueError("missing ')' in query")
+            position += 1
+            return child
+        words = [Term(word) for word in analyzer.tokens(token)]
+        return words[0] if len(words) == 1 else (And(words) if words else None)
+
+    if not tokens:
+        return None
+    tree = parse_or()
+    if position < len(tokens):
+        raise ValueError("unexpected %r in query" % tokens[position])
+    return tree
+
+
+def plan(node, document_frequency):
+    """ Rewrite a parsed query into an evaluation plan; document_frequency(word) sizes the terms.
+
+    >>> from common.analysis import Analyzer
+    >>> df = {'first': 1, 'second': 1, 'third': 1, 'document': 3}
+    >>> plan(parse('document AND NOT (first OR third) second', Analyzer()), lambda word: df.get(word, 0))
+    Difference(And(Term('second'), Term('document')), Or(Term('first'), Term('third')))
+    >>> plan(parse('first AND missing', Analyzer()), lambda word: df.get(word, 0))
+    Empty()
+    """
+    if node is None:
+        return Empty()
+    planned = _plan(node, document_frequency)
+    return planned if planned.size else Empty()
+
+
+def _plan(node, document_frequency):
+    if isinstance(node, Term):
+        node.size = document_frequency(node.word)
+        return node
+    if isinstance(node, Not):
+        # A negation is planned as an AND of one operand, which needs a positive operand after all
+        node = And([node])
+    if isinstance(node, Or):
+        children = {}
+        for child in _flatten(node, Or):
+            child = _plan(child, document_frequency)
+            if child.size:
+                children.setdefault(repr(child), child)
+        if not children:
+            return Empty()
+        if len(children) == 1:
+            return next(iter(children.values()))
+        planned = Or(sorted(children.values(), key=lambda child: child.size))
+        planned.size = sum(child.size for child in planned.children)
+        return planned
+    # An AND: plan the positive operands and the negated ones separately
+    positives = {}
+    negatives = {}
+    for child in _flatten(node, And):
+        negated = False
+        while isinstance(child, Not):
+            child = child.child
+            negated = not negated
+        child = _plan(child, document_frequency)
+        if negated:
+            if child.size:
+                negatives.setdefault(repr(child), child)
+        elif not child.size:
+            return Empty()
+        else:
+            positives.setdefault(repr(child), child)
+    if not positives:
+        raise ValueError('NOT needs a positive operand to subtract from, as in "a AND NOT b"')
+    # The rarest operand drives the intersection
+    positives = sorted(positives.values(), key=lambda child: child.size)
+    if len(positives) == 1:
+        planned = positives[0]
+    else:
+        planned = And(positives)
+        planned.size = positives[0].size
+    if negatives:
+        # Check the negated plan most likely to reject a candidate first
+        planned = Difference(planned, sorted(negatives.values(), key=lambda child: child.size, reverse=True))
+    return planned
+
+
+def _flatten(node, kind):
+    """ Yield the operands of nested nodes of the same kind. """
+    for child in node.children:
+        if isinstance(child, kind):
+            yield from _flatten(child, kind)
+        else:
+            yield child
+
+
+class ListCursor:
+    """ Cursor over a sorted sequence of document ids that gallops forward. """
+
+    def __init__(self, doc_ids):
+        self.doc_ids = doc_ids
+        self.position = 0
+
+    def next_geq(self, target):
+        doc_ids = self.doc_ids
+        size = len(doc_ids)
+        low = self.position
+        if low < size and doc_ids[low] >= target:
+            return doc_ids[low]
+        # Double the step until doc_ids[low + step] >= target, then binary search that range
+        step = 1
+        while low + step < size and doc_ids[low + step] < target:
+            step *= 2
+        self.position = low = bisect_left(doc_ids, target, low, min(low + step + 1, size))
+        return doc_ids[low] if low < size else None
+
+
+class AndCursor:
+    """ Leapfrog intersection; the first cursor should be the one with the fewest documents. """
+
+    def __init__(self, cursors):
+        self.cursors = cursors
+
+    def next_geq(self, target):
+        cursors = self.cursors
+        candidate = cursors[0].next_geq(target)
+        matched = 1
+        index = 1
+        while candidate is not None and matched < len(cursors):
+            doc_id = cursors[index].next_geq(candidate)
+            if doc_id is None:
+                return None
+            if doc_id == candidate:
+                matched += 1
+            else:
+                # Every other cursor has to catch up with the new candidate
+                candidate = doc_id
+                matched = 1
+            index = (index + 1) % len(cursors)
+        return candidate
+
+
+class OrCursor:
+    """ Union of cursors merged with a heap of their current documents. """
+
+    def __init__(self, cursors):
+        self.heap = []
+        self.cursors = cursors
+        self.started = False
+
+    def next_geq(self, target):
+        heap = self.heap
+        if not self.started:
+            self.started = True
+            for index, cursor in enumerate(self.cursors):
+                doc_id = cursor.next_geq(target)
+                if doc_id is not None:
+                    heap.append((doc_id, index))
+            heapq.heapify(heap)
+        while heap and heap[0][0] < target:
+            index = heap[0][1]
+            doc_id = self.cursors[index].next_geq(target)
+            if doc_id is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (doc_id, index))
+        return heap[0][0] if heap else None
+
+
+class DifferenceCursor:
+    """ Documents of the positive cursor found by none of the negative cursors. """
+
+    def __init__(self, positive, negatives):
+        self.positive = positive
+        self.negatives = negatives
+
+    def next_geq(self, target):
+        doc_id = self.positive.next_geq(target)
+        while doc_id is not None:
+            if all(negative.next_geq(doc_id) != doc_id for negative in self.negatives):
+                return doc_id
+            doc_id = self.positive.next_geq(doc_id + 1)
+        return None
+
+
+class EmptyCursor:
+    def next_geq(self, target):
+        return None
+
+
+def cursor(node, open_cursor):
+    """ Build the cursor of a plan; open_cursor(word) returns a cursor over the postings of word. """
+    if isinstance(node, Term):
+        return open_cursor(node.word)
+    if isinstance(node, And):
+        return AndCursor([cursor(child, open_cursor) for child in node.children])
+    if isinstance(node, Or):
+        return OrCursor([cursor(child, open_cursor) for child in node.children])
+    if isinstance(node, Difference):
+        return DifferenceCursor(cursor(node.positive, open_cursor),
+                                [cursor(negative, open_cursor) for negative in node.negatives])
+    return EmptyCursor()
+
+
+def evaluate(node, open_cursor):
+    """ Yield the document ids matched by a plan in increasing order.
+
+    >>> postings = {'a': [1, 3, 5, 7], 'b': [3, 4, 5], 'c': [5, 9]}
+    >>> open_cursor = lambda word: ListCursor(postings[word])
+    >>> list(evaluate(Or([Term('b'), Term('c')]), open_cursor))
+    [3, 4, 5, 9]
+    >>> list(evaluate(Difference(And([Term('b'), Term('a')]), [Term('c')]), open_cursor))
+    [3]
+    """
+    documents = cursor(node, open_cursor)
+    doc_id = documents.next_geq(0)
+    while doc_id is not None:
+        yield doc_id
+        doc_id = documents.next_geq(doc_id + 1)
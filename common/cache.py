@@ -0,0 +1,145 @@
+""" Bounded LRU caches for query results and posting lists.
+
+The caches are safe to share between the threads of a query server.
+Every entry is tagged with the generation of the index it was computed from.
+Indexes bump their generation whenever documents are added, deleted or
+rescored, and the first lookup with a new generation empties the cache, so a
+cached result is never older than the index it is returned for.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """ Keep at most max_size entries, evicting the least recently used one.
+
+    Entries may be given a weight, such as the length of a posting list. The
+    cache then also keeps the total weight within max_weight, and does not
+    store entries lighter than min_weight, which are cheap to recompute.
+
+    >>> cache = LRUCache(2)
+    >>> cache.get('a', 0) is None
+    True
+    >>> cache.put('a', 0, 1)
+    >>> cache.put('b', 0, 2)
+    >>> cache.get('a', 0)
+    1
+    >>> cache.put('c', 0, 3)
+    >>> cache.get('b', 0) is None
+    True
+    >>> cache.get('c', 1) is None
+    True
+    >>> cache.stats()
+    {'hits': 1, 'misses': 3, 'evictions': 1, 'invalidations': 1, 'size': 0, 'weight': 0}
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(cache)).max_size
+    2
+    >>> weighted = LRUCache(10, max_weight=100, min_weight=5)
+    >>> for key, weight in (('rare', 2), ('hot', 60), ('hotter', 70)):
+    ...     weighted.put(key, 0, key, weight)
+    >>> list(weighted.entries), weighted.stats()['weight']
+    (['hotter'], 70)
+    """
+
+    def __init__(self, max_size, max_weight=None, min_weight=0):
+        self.max_size = max_size
+        self.max_weight = max_weight
+        self.min_weight = min_weight
+        self.entries = OrderedDict()
+        self.weights = {}
+        self.weight = 0
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """ Pickle an empty cache of the same size; entries are only reused by the process that stored them. """
+        return {'max_size': self.max_size, 'max_weight': self.max_weight, 'min_weight': self.min_weight}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_size'], state.get('max_weight'), state.get('min_weight', 0))
+
+    def _check(self, generation):
+        """ Drop every entry when the index changed since they were stored. """
+        if generation != self.generation:
+            if self.entries:
+                self.invalidations += 1
+                self._clear()
+            self.generation = generation
+
+    def _clear(self):
+        self.entries.clear()
+        self.weights.clear()
+        self.weight = 0
+
+    def get(self, key, generation, default=None):
+        """ Return the entry for key, or default when it is missing or stale. """
+        with self.lock:
+            self._check(generation)
+            value = self.entries.get(key, self)
+            if value is self:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, generation, value, weight=1):
+        """ Store value for key, evicting the least recently used entries beyond max_size or max_weight. """
+        with self.lock:
+            self._check(generation)
+            if self.max_size <= 0 or weight < self.min_weight:
+                return
+            if self.max_weight is not None and weight > self.max_weight:
+                return
+            self.weight += weight - self.weights.get(key, 0)
+            self.entries[key] = value
+            self.weights[key] = weight
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size or (self.max_weight is not None and self.weight > self.max_weight):
+                evicted, _ = self.entries.popitem(last=False)
+                self.weight -= self.weights.pop(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """ Remove every entry; the counters are kept. """
+        with self.lock:
+            self._clear()
+
+    def stats(self):
+        """ Return the hit, miss, eviction and invalidation counters, the current size and total weight. """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'size': len(self.entries), 'weight': self.weight}
+
+
+class QueryCache:
+    """ The result cache and the posting-list cache of one index.
+
+    Results are keyed on the normalized query tokens and the search
+    parameters, posting lists on the term. A size of 0 disables a cache.
+    Posting lists are weighted by their number of postings: only lists of
+    at least min_posting_entries are kept, and at most max_posting_entries
+    postings in total.
+
+    >>> cache = QueryCache(max_results=1, max_posting_entries=10, min_posting_entries=2)
+    >>> cache.results.put((('first',), 10), 0, [(0, 1.5)])
+    >>> cache.postings.put('first', 0, ([0], [1]), 1)
+    >>> cache.postings.put('document', 0, ([0, 1, 2], [1, 1, 1]), 3)
+    >>> cache.stats()['results']['size'], cache.stats()['postings']['size']
+    (1, 1)
+    """
+
+    def __init__(self, max_results=1024, max_postings=256, max_posting_entries=2 ** 20, min_posting_entries=1024):
+        self.results = LRUCache(max_results)
+        self.postings = LRUCache(max_postings, max_posting_entries, min_posting_entries)
+
+    def clear(self):
+        self.results.clear()
+        self.postings.clear()
+
+    def stats(self):
+        return {'results': self.results.stats(), 'postings': self.postings.stats()}
@@ -0,0 +1,177 @@
+""" A versioned binary index file opened through mmap.
+
+Layout (native byte order, every section aligned to 8 bytes):
+
+    header      magic (8 bytes), version (u32), reserved (u32),
+                metadata offset (u64), metadata length (u64)
+    sections    doc_ids          u32 doc ids of all posting lists, contiguous
+                values           one value (frequency or weight) per doc id
+                term_bytes       UTF-8 bytes of the sorted terms
+                term_offsets     u64 per term + 1, start of every term in term_bytes
+                postings_offsets u64 per term + 1, start of every posting list
+                any extra per-document arrays
+    metadata    JSON describing every section as [typecode, offset, count]
+                plus the scalar statistics of the index
+
+Opening a file only parses the header and the metadata; posting lists are
+memoryview slices of the mapping, so pages are faulted in lazily and several
+read-only processes share the same page cache.
+"""
+
+import json
+import mmap
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from collections.abc import Mapping
+
+MAGIC = b'IRINDEX\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQ')
+
+
+def _align(file):
+    padding = -file.tell() % 8
+    if padding:
+        file.write(b'\x00' * padding)
+
+
+def is_index_file(path):
+    """ Tell whether path starts with the index file magic. """
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def write_index(path, entries, values_type='I', arrays=None, metadata=None):
+    """ Write an index file.
+
+    entries yields (term, doc ids, values) in term order, values may be None
+    when the index has no per-posting values. entries may be a generator:
+    posting lists are streamed to disk, so only the dictionary is held in
+    memory. arrays maps names to (typecode, sequence)
+    for per-document data and metadata holds JSON-serializable statistics.
+    """
+    term_bytes = bytearray()
+    term_offsets = array('Q', [0])
+    postings_offsets = array('Q', [0])
+    layout = {}
+    with open(path, 'wb') as file, tempfile.TemporaryFile() as values:
+        file.write(b'\x00' * HEADER.size)
+        _align(file)
+        doc_ids_offset = file.tell()
+        value_count = 0
+        for term, docs, weights in entries:
+            term_bytes += term.encode('utf8')
+            term_offsets.append(len(term_bytes))
+            docs = array('I', docs)
+            docs.tofile(file)
+            postings_offsets.append(postings_offsets[-1] + len(docs))
+            if weights is not None:
+                weights = array(values_type, weights)
+                weights.tofile(values)
+                value_count += len(weights)
+        layout['doc_ids'] = ['I', doc_ids_offset, postings_offsets[-1]]
+
+        _align(file)
+        layout['values'] = [values_type, file.tell(), value_count]
+        values.seek(0)
+        shutil.copyfileobj(values, file)
+
+        sections = [('term_bytes', array('B', term_bytes)), ('term_offsets', term_offsets),
+                    ('postings_offsets', postings_offsets)]
+        for name, (typecode, data) in (arrays or {}).items():
+            sections.append((name, array(typecode, data)))
+        for name, data in sections:
+            _align(file)
+            layout[name] = [data.typecode, file.tell(), len(data)]
+            data.tofile(file)
+
+        _align(file)
+        metadata_offset = file.tell()
+        encoded = json.dumps({'byteorder': sys.byteorder, 'term_count': len(term_offsets) - 1,
+                              'sections': layout, 'statistics': metadata or {}}).encode('utf8')
+        file.write(encoded)
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, VERSION, 0, metadata_offset, len(encoded)))
+
+
+class IndexFile:
+    """ Read-only view of an index file written by write_index. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, metadata_offset, metadata_length = HEADER.unpack_from(self.mapping, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not an index file' % path)
+        if version != VERSION:
+            raise ValueError('unsupported index file version %d' % version)
+        metadata = json.loads(self.mapping[metadata_offset:metadata_offset + metadata_length])
+        if metadata['byteorder'] != sys.byteorder:
+            raise ValueError('index file was written with %s byte order' % metadata['byteorder'])
+        self.term_count = metadata['term_count']
+        self.statistics = metadata['statistics']
+        self.view = memoryview(self.mapping)
+        self.sections = {name: self.view[offset:offset + count * array(typecode).itemsize].cast(typecode)
+                         for name, (typecode, offset, count) in metadata['sections'].items()}
+        self.term_bytes = self.sections['term_bytes']
+        self.term_offsets = self.sections['term_offsets']
+        self.postings_offsets = self.sections['postings_offsets']
+
+    def term(self, index):
+        return bytes(self.term_bytes[self.term_offsets[index]:self.term_offsets[index + 1]]).decode('utf8')
+
+    def find(self, term):
+        """ Binary search the sorted dictionary, return the term position or -1. """
+        key = term.encode('utf8')
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            candidate = bytes(self.term_bytes[self.term_offsets[middle]:self.term_offsets[middle + 1]])
+            if candidate < key:
+                low = middle + 1
+            elif candidate > key:
+                high = middle
+            else:
+                return middle
+        return -1
+
+    def doc_ids(self, index):
+        return self.sections['doc_ids'][self.postings_offsets[index]:self.postings_offsets[index + 1]]
+
+    def values(self, index):
+        return self.sections['values'][self.postings_offsets[index]:self.postings_offsets[index + 1]]
+
+    def array(self, name):
+        return self.sections[name]
+
+    def close(self):
+        for section in self.sections.values():
+            section.release()
+        self.view.release()
+        self.mapping.close()
+
+
+class TermMapping(Mapping):
+    """ Read-only term -> value mapping over an IndexFile; values are built on access by factory(position). """
+
+    def __init__(self, index_file, factory):
+        self.index_file = index_file
+        self.factory = factory
+
+    def __getitem__(self, term):
+        position = self.index_file.find(term)
+        if position < 0:
+            raise KeyError(term)
+        return self.factory(position)
+
+    def __contains__(self, term):
+        return self.index_file.find(term) >= 0
+
+    def __iter__(self):
+        return (self.index_file.term(position) for position in range(self.index_file.term_count))
+
+    def __len__(self):
+        return self.index_file.term_count
@@ -0,0 +1,202 @@
+""" Optional per-query and per-build profiling for the index and ranking modules.
+
+An index created with instrumentation=Instrumentation() profiles its searches
+and builds. Each one gets a Profile that adds up the time spent in named
+phases (tokenize, postings, score, sort, ...) and counts events (postings
+read, documents scored, heap operations, cache hits). A finished profile is
+added to the aggregated totals, passed to every hook, and logged as a slow
+query when it took longer than slow_query_seconds.
+
+Without instrumentation the modules get NULL_PROFILE, whose methods do
+nothing. Disabled profiling therefore costs a few empty calls per query and
+no timing at all.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class NullProfile:
+    """ Stand-in for Profile when instrumentation is disabled. """
+
+    enabled = False
+
+    def phase(self, name):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def finish(self):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+class Profile:
+    """ Phase timings and event counts of one operation.
+
+    >>> instrumentation = Instrumentation()
+    >>> profile = instrumentation.begin('search', 'first document')
+    >>> profile.phase('tokenize')
+    >>> profile.count('postings', 3)
+    >>> profile.phase('score')
+    >>> profile.count('postings', 2)
+    >>> profile.finish()
+    >>> sorted(profile.phases), profile.counts
+    (['score', 'tokenize'], {'postings': 5})
+    """
+
+    enabled = True
+
+    def __init__(self, instrumentation, operation, label=None):
+        self.instrumentation = instrumentation
+        self.operation = operation
+        self.label = label
+        self.phases = {}
+        self.counts = {}
+        self.seconds = None
+        self.start = self._mark = time.perf_counter()
+        self._phase = None
+
+    def phase(self, name):
+        """ End the current phase and start the phase name; time spent in a phase is summed. """
+        now = time.perf_counter()
+        if self._phase is not None:
+            self.phases[self._phase] = self.phases.get(self._phase, 0.0) + now - self._mark
+        self._phase = name
+        self._mark = now
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def finish(self):
+        """ End the last phase and report the profile to the instrumentation. """
+        self.phase(None)
+        self.seconds = self._mark - self.start
+        self.instrumentation.record(self)
+
+    def as_dict(self):
+        return {'operation': self.operation, 'label': self.label, 'seconds': self.seconds,
+                'phases': dict(self.phases), 'counts': dict(self.counts)}
+
+
+class Instrumentation:
+    """ Aggregate the profiles of an index, call hooks and keep a slow-query log.
+
+    >>> instrumentation = Instrumentation(slow_query_seconds=0.0)
+    >>> seen = []
+    >>> instrumentation.add_hook(lambda profile: seen.append(profile.label))
+    >>> for query in ('first', 'second'):
+    ...     profile = instrumentation.begin('search', query)
+    ...     profile.count('documents_scored', 2)
+    ...     profile.finish()
+    >>> snapshot = instrumentation.snapshot()
+    >>> seen, snapshot['operations']['search']['calls'], snapshot['operations']['search']['counts']
+    (['first', 'second'], 2, {'documents_scored': 4})
+    >>> [entry['label'] for entry in snapshot['slow_queries']]
+    ['first', 'second']
+    """
+
+    def __init__(self, slow_query_seconds=None, slow_log_size=100, hooks=()):
+        self.slow_query_seconds = slow_query_seconds
+        self.slow_queries = deque(maxlen=slow_log_size)
+        self.hooks = list(hooks)
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """ Call hook(profile) for every finished profile. """
+        self.hooks.append(hook)
+
+    def begin(self, operation, label=None):
+        return Profile(self, operation, label)
+
+    def record(self, profile):
+        with self.lock:
+            totals = self.operations.get(profile.operation)
+            if totals is None:
+                totals = self.operations[profile.operation] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                               'phases': {}, 'counts': {}}
+            totals['calls'] += 1
+            totals['seconds'] += profile.seconds
+            totals['max_seconds'] = max(totals['max_seconds'], profile.seconds)
+            for name, seconds in profile.phases.items():
+                totals['phases'][name] = totals['phases'].get(name, 0.0) + seconds
+            for name, value in profile.counts.items():
+                totals['counts'][name] = totals['counts'].get(name, 0) + value
+            slow = (profile.operation == 'search' and self.slow_query_seconds is not None
+                    and profile.seconds >= self.slow_query_seconds)
+            if slow:
+                self.slow_queries.append(profile.as_dict())
+        if slow:
+            logger.warning('slow query %r took %.6f s: %s', profile.label, profile.seconds, profile.phases)
+        for hook in self.hooks:
+            hook(profile)
+
+    def snapshot(self):
+        """ Return a copy of the aggregated totals per operation and of the slow-query log. """
+        with self.lock:
+            return {'operations': {operation: {'calls': totals['calls'], 'seconds': totals['seconds'],
+                                               'max_seconds': totals['max_seconds'],
+                                               'phases': dict(totals['phases']),
+                                               'counts': dict(totals['counts'])}
+                                   for operation, totals in self.operations.items()},
+                    'slow_queries': list(self.slow_queries)}
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.slow_queries.clear()
+
+
+def begin(instrumentation, operation, label=None):
+    """ Start a profile, or return NULL_PROFILE when instrumentation is None.
+
+    label may be a list of query terms; they are joined only when a profile is started.
+
+    >>> begin(Instrumentation(), 'search', ['first', 'document']).label
+    'first document'
+    """
+    if instrumentation is None:
+        return NULL_PROFILE
+    if isinstance(label, list):
+        label = ' '.join(label)
+    return instrumentation.begin(operation, label)
+
+
+def profile_iteration(profile, iterable, phase, counter):
+    """ Return iterable, timing its iteration as phase and counting its items as counter.
+
+    The profile finishes when the iteration ends or the iterator is closed,
+    so the results of a lazy search are part of its profile. The phase also
+    covers the time the caller spends between items.
+
+    >>> instrumentation = Instrumentation()
+    >>> profile = instrumentation.begin('search', 'first OR second')
+    >>> list(profile_iteration(profile, iter([1, 2]), 'evaluate', 'documents_matched'))
+    [1, 2]
+    >>> snapshot = instrumentation.snapshot()['operations']['search']
+    >>> sorted(snapshot['phases']), snapshot['counts']
+    (['evaluate'], {'documents_matched': 2})
+    """
+    if not profile.enabled:
+        return iterable
+    return _profiled(profile, iterable, phase, counter)
+
+
+def _profiled(profile, iterable, phase, counter):
+    profile.phase(phase)
+    items = 0
+    try:
+        for item in iterable:
+            items += 1
+            yield item
+    finally:
+        profile.count(counter, items)
+        profile.finish()
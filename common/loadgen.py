@@ -0,0 +1,110 @@
+""" Send queries to a query server from many connections and report throughput and latency.
+
+    python -m common.loadgen ADDRESS QUERY_FILE [--connections 16] [--depth 1]
+                             [--requests 1000] [--k 10]
+
+ADDRESS is 'HOST:PORT', 'PORT' or 'unix:PATH' and QUERY_FILE has one query per
+line; queries are sent round-robin. Every connection keeps depth requests
+outstanding, so connections * depth is the number of concurrent requests. The
+report is printed as JSON.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import sys
+import time
+
+from common.server import open_connection
+
+
+def percentile(values, fraction):
+    """ Return the nearest-rank percentile of sorted values.
+
+    >>> values = list(range(1, 101))
+    >>> percentile(values, 0.5), percentile(values, 0.99), percentile(values, 1.0), percentile([], 0.5)
+    (50, 99, 100, 0.0)
+    """
+    if not values:
+        return 0.0
+    return values[max(1, math.ceil(len(values) * fraction)) - 1]
+
+
+async def _connection(address, queries, remaining, k, depth, latencies, errors):
+    reader, writer = await open_connection(address)
+    loop = asyncio.get_running_loop()
+    pending = {}
+    ids = itertools.count()
+
+    async def receive():
+        # Responses may arrive out of order, so they are matched to requests by id
+        while True:
+            line = await reader.readline()
+            if not line:
+                for future in pending.values():
+                    future.set_exception(ConnectionError('server closed the connection'))
+                return
+            response = json.loads(line)
+            pending.pop(response['id']).set_result(response)
+
+    async def send():
+        while next(remaining, None) is not None:
+            request_id = next(ids)
+            future = pending[request_id] = loop.create_future()
+            start = time.perf_counter()
+            writer.write(json.dumps({'id': request_id, 'query': next(queries), 'k': k}).encode('utf8') + b'\n')
+            response = await future
+            latencies.append(time.perf_counter() - start)
+            if 'error' in response:
+                errors[response['error']] = errors.get(response['error'], 0) + 1
+
+    receiver = loop.create_task(receive())
+    try:
+        await asyncio.gather(*(send() for _ in range(depth)))
+    finally:
+        receiver.cancel()
+        writer.close()
+
+
+async def run_load(address, queries, connections=16, depth=1, requests=1000, k=10):
+    """ Send requests queries over connections connections and return the report dictionary. """
+    queries = itertools.cycle(queries)
+    remaining = iter(range(requests))
+    latencies = []
+    errors = {}
+    start = time.perf_counter()
+    await asyncio.gather(*(_connection(address, queries, remaining, k, depth, latencies, errors)
+                           for _ in range(connections)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': seconds,
+        'throughput': len(latencies) / seconds if seconds else 0.0,
+        'latency_ms': {name: 1000 * percentile(latencies, fraction)
+                       for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate load against a query server.')
+    parser.add_argument('address')
+    parser.add_argument('query_file')
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args(argv)
+    with open(args.query_file, encoding="utf8") as file:
+        queries = [line.strip() for line in file if line.strip()]
+    if not queries:
+        sys.exit('no queries in %s' % args.query_file)
+    report = asyncio.run(run_load(args.address, queries, args.connections, args.depth, args.requests, args.k))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
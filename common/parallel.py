@@ -0,0 +1,52 @@
+""" Split a text file into line-aligned shards and index them in worker processes.
+
+A shard is a byte range [start, end) that starts at the beginning of a line.
+How a worker numbers the lines of its shard is up to its function: the record
+ids of the Boolean indexes count from 1, the document ids of the ranking
+engines from 0. Either way a worker reports how many lines it read, so the
+caller turns local numbers into global ones by adding the line counts of the
+preceding shards.
+"""
+
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def split_lines(path, shards):
+    """ Split a file into at most shards byte ranges whose boundaries fall at line starts. """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as file:
+        for shard in range(1, shards):
+            position = max(size * shard // shards, boundaries[-1])
+            if position >= size:
+                break
+            file.seek(position)
+            if position > 0:
+                # Move to the start of the next line unless position already is one
+                file.seek(position - 1)
+                file.readline()
+            position = file.tell()
+            if position > boundaries[-1] and position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iter_lines(path, start, end):
+    """ Yield the lines of a byte range decoded like open(path, encoding="utf8") would. """
+    with open(path, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    return io.StringIO(data.decode('utf8'), newline=None)
+
+
+def map_shards(function, path, workers=None):
+    """ Run function(path, start, end) on every shard in a process pool, results in file order. """
+    workers = workers or os.cpu_count() or 1
+    ranges = split_lines(path, workers)
+    if len(ranges) <= 1:
+        return [function(path, start, end) for start, end in ranges]
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges))) as executor:
+        return list(executor.map(function, [path] * len(ranges), *zip(*ranges)))
@@ -0,0 +1,102 @@
+""" Compressed token position lists and the merges behind phrase and proximity queries.
+
+Positions of a word in one document are stored as variable-byte coded gaps:
+7 bits per byte, the high bit marks the last byte of a number.
+"""
+
+import heapq
+
+
+def encode_positions(positions):
+    """ Encode an ascending list of positions.
+
+    >>> encode_positions([0, 5, 300])
+    b'\\x80\\x85\\x02\\xa7'
+    """
+    data = bytearray()
+    previous = 0
+    for position in positions:
+        gap = position - previous
+        previous = position
+        groups = [gap & 0x7f | 0x80]
+        gap >>= 7
+        while gap:
+            groups.append(gap & 0x7f)
+            gap >>= 7
+        data.extend(reversed(groups))
+    return bytes(data)
+
+
+def decode_positions(data):
+    """ Decode positions written by encode_positions.
+
+    >>> decode_positions(encode_positions([0, 5, 300]))
+    [0, 5, 300]
+    """
+    positions = []
+    position = 0
+    gap = 0
+    for byte in data:
+        if byte & 0x80:
+            position += (gap << 7) | (byte & 0x7f)
+            positions.append(position)
+            gap = 0
+        else:
+            gap = (gap << 7) | byte
+    return positions
+
+
+def phrase_starts(position_lists):
+    """ Return the positions where the words of a phrase occur one after another.
+
+    position_lists holds the positions of every phrase word, in phrase order.
+
+    >>> phrase_starts([[1, 4, 9], [2, 7, 10], [3, 11]])
+    [1, 9]
+    """
+    starts = position_lists[0]
+    for offset, positions in enumerate(position_lists[1:], 1):
+        shifted = set(position - offset for position in positions)
+        starts = [start for start in starts if start in shifted]
+        if not starts:
+            break
+    return starts
+
+
+def min_span(position_lists):
+    """ Return the length - 1 of the shortest window containing a position from every list.
+
+    >>> min_span([[1, 20], [8, 22], [25]])
+    5
+    """
+    heap = [(positions[0], index, 0) for index, positions in enumerate(position_lists)]
+    heapq.heapify(heap)
+    highest = max(position for position, _, _ in heap)
+    best = highest - heap[0][0]
+    while True:
+        position, index, offset = heapq.heappop(heap)
+        best = min(best, highest - position)
+        if offset + 1 == len(position_lists[index]):
+            return best
+        following = position_lists[index][offset + 1]
+        highest = max(highest, following)
+        heapq.heappush(heap, (following, index, offset + 1))
+
+
+def min_distance(first, second):
+    """ Return the smallest distance between a position of first and one of second.
+
+    >>> min_distance([1, 10, 30], [14, 28])
+    2
+    """
+    best = None
+    i = j = 0
+    while i < len(first) and j < len(second):
+        distance = abs(first[i] - second[j])
+        if best is None or distance < best:
+            best = distance
+        if first[i] < second[j]:
+            i += 1
+        else:
+            j += 1
+    return best
@@ -0,0 +1,254 @@
+""" Serve an index to many clients over line-delimited JSON, batching queries that arrive together.
+
+A request is one JSON object per line, {"id": 1, "query": "first document", "k": 10}.
+The response echoes the id with either "results", a list of [doc id, score] pairs,
+or "error". Responses are written as soon as they are ready, so a client that
+pipelines requests matches them by id.
+
+Requests wait in a bounded queue. A batcher task collects the requests that
+arrive within batch_window seconds of each other, up to max_batch, and runs
+them as one batch on a thread pool, so the event loop keeps accepting clients.
+When the queue is full a request is refused with the error "overloaded". A
+connection is not read while max_inflight of its requests are pending, which
+pushes back on the client through TCP flow control. A request that is not
+answered within timeout seconds gets the error "timeout".
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_address(address):
+    """ Split 'unix:PATH', 'HOST:PORT' or 'PORT' into (host, port, path).
+
+    >>> parse_address('unix:/tmp/index.sock'), parse_address('0.0.0.0:8000'), parse_address('8000')
+    ((None, None, '/tmp/index.sock'), ('0.0.0.0', 8000, None), ('127.0.0.1', 8000, None))
+    """
+    if address.startswith('unix:'):
+        return None, None, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port), None
+
+
+async def open_connection(address):
+    """ Connect to a server address in the format of parse_address. """
+    host, port, path = parse_address(address)
+    if path is not None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+
+def batch_searcher(index):
+    """ Return a function answering a list of (query, k) pairs with an index.
+
+    Indexes with a search_batch method get one call per distinct k, others one
+    search call per query.
+    """
+    search_batch = getattr(index, 'search_batch', None)
+
+    def run(requests):
+        if search_batch is None:
+            return [index.search(query, k) for query, k in requests]
+        results = [None] * len(requests)
+        positions_by_k = {}
+        for position, (_, k) in enumerate(requests):
+            positions_by_k.setdefault(k, []).append(position)
+        for k, positions in positions_by_k.items():
+            batch = search_batch([requests[position][0] for position in positions], k)
+            for position, result in zip(positions, batch):
+                results[position] = result
+        return results
+
+    return run
+
+
+class QueryServer:
+    """ Answer JSON search requests with search_batch, a function of a list of (query, k) pairs.
+
+    >>> async def example():
+    ...     server = QueryServer(lambda requests: [[(len(query), float(k))] for query, k in requests])
+    ...     await server.start()
+    ...     reader, writer = await open_connection('%s:%d' % server.address)
+    ...     writer.write(b'{"id": 7, "query": "first", "k": 2}\\n{"query": 1}\\n')
+    ...     responses = [json.loads(await reader.readline()) for _ in range(2)]
+    ...     writer.close()
+    ...     await server.close()
+    ...     return sorted(responses, key=str)
+    >>> asyncio.run(example())
+    [{'id': 7, 'results': [[5, 2.0]]}, {'id': None, 'error': 'bad request'}]
+    """
+
+    def __init__(self, search_batch, max_batch=64, batch_window=0.002, workers=None,
+                 max_pending=1024, max_inflight=64, timeout=5.0, max_k=1000):
+        self.search_batch = search_batch
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self.max_k = max_k
+        self.stats = {'requests': 0, 'batches': 0, 'batched_requests': 0,
+                      'overloaded': 0, 'timeouts': 0, 'errors': 0}
+        self.server = None
+        self.queue = None
+        self.slots = None
+        self.executor = None
+        self._batcher_task = None
+        self._batches = set()
+        self._handlers = {}
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """ Listen on a TCP port, or on a Unix socket when path is given. """
+        self.queue = asyncio.Queue(self.max_pending)
+        self.slots = asyncio.Semaphore(self.workers)
+        self.executor = ThreadPoolExecutor(self.workers)
+        self._batcher_task = asyncio.get_running_loop().create_task(self._batcher())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def close(self):
+        """ Stop listening, drop the open connections and shut the worker pool down. """
+        self.server.close()
+        # A closed connection reads end of file, so its handler returns
+        for writer in self._handlers.values():
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self.server.wait_closed()
+        self._batcher_task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def _handle(self, reader, writer):
+        self._handlers[asyncio.current_task()] = writer
+        inflight = asyncio.Semaphore(self.max_inflight)
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        def finished(task):
+            tasks.discard(task)
+            inflight.release()
+
+        try:
+            while True:
+                # Stop reading while too many requests of this connection are pending
+                await inflight.acquire()
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(self._answer(line, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(finished)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (ConnectionError, ValueError):
+            # The client went away or sent a line longer than the stream limit
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._handlers.pop(asyncio.current_task(), None)
+            writer.close()
+
+    async def _answer(self, line, writer, write_lock):
+        response = await self._respond(line)
+        async with write_lock:
+            try:
+                writer.write(json.dumps(response).encode('utf8') + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def _respond(self, line):
+        self.stats['requests'] += 1
+        request = None
+        try:
+            request = json.loads(line)
+            query = request['query']
+            k = int(request.get('k', 10))
+            if not isinstance(query, str) or not 0 <= k <= self.max_k:
+                raise ValueError(line)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.stats['errors'] += 1
+            return {'id': request.get('id') if isinstance(request, dict) else None, 'error': 'bad request'}
+        request_id = request.get('id')
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((query, k, future))
+        except asyncio.QueueFull:
+            self.stats['overloaded'] += 1
+            return {'id': request_id, 'error': 'overloaded'}
+        try:
+            # A timeout cancels the future, so the batcher skips the request if it has not run yet
+            results = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            return {'id': request_id, 'error': 'timeout'}
+        except Exception as error:
+            self.stats['errors'] += 1
+            return {'id': request_id, 'error': str(error)}
+        return {'id': request_id, 'results': [[int(doc_id), float(score)] for doc_id, score in results]}
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # Give concurrent requests a short window to join the batch unless it is already full
+            if self.batch_window > 0 and self.queue.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            batch = [request for request in batch if not request[2].done()]
+            if not batch:
+                continue
+            # At most one batch per worker runs at a time; the others wait in the queue
+            await self.slots.acquire()
+            task = loop.create_task(self._run(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.search_batch,
+                                                 [(query, k) for query, k, _ in batch])
+        except Exception as error:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            self.stats['batches'] += 1
+            self.stats['batched_requests'] += len(batch)
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.slots.release()
+
+
+def serve(index, address, **options):
+    """ Serve index at address until interrupted; options are passed to QueryServer. """
+    host, port, path = parse_address(address)
+
+    async def main():
+        server = QueryServer(batch_searcher(index), **options)
+        await server.start(host, port, path)
+        print('Serving on %s' % address, flush=True)
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
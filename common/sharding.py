@@ -0,0 +1,135 @@
+""" Search a collection split over worker processes with scatter-gather.
+
+Each worker process owns the documents of one line-aligned shard of a file and
+builds its index with open_shard(path, start, end). That is a module-level
+function of a ranking module, and it returns an index with these methods:
+
+    local_statistics()             -> {'num_documents': n, 'total_len': t, 'df': {term: df}}
+    use_global_statistics(n, t, df)   score with the statistics of the whole collection
+    search(query, k)               -> [(local doc id, score), ...]
+
+At startup the coordinator sums the local statistics and sends the totals
+back, so every shard scores with the global N, df and average document length.
+Scores are then identical to those of a single index over the whole file. A
+query goes to all shards at once. Each shard returns its local top k, and the
+coordinator shifts the local doc ids by the shard offsets and keeps the k best
+results, breaking ties by doc id like the single-index search does.
+"""
+
+import heapq
+import multiprocessing
+import threading
+
+from common.parallel import split_lines
+
+
+def _shard_worker(connection, open_shard, path, start, end):
+    """ Build the index of one shard, then answer the commands of the coordinator until 'close'. """
+    try:
+        index = open_shard(path, start, end)
+        connection.send(index.local_statistics())
+    except Exception as error:
+        connection.send(error)
+        return
+    while True:
+        command, args = connection.recv()
+        if command == 'close':
+            break
+        try:
+            if command == 'statistics':
+                index.use_global_statistics(*args)
+                connection.send(None)
+            elif command == 'search':
+                queries, k = args
+                connection.send([index.search(query, k) for query in queries])
+        except Exception as error:
+            connection.send(error)
+
+
+def merge_statistics(statistics):
+    """ Sum the local statistics of the shards.
+
+    >>> merge_statistics([{'num_documents': 2, 'total_len': 4, 'df': {'first': 1, 'document': 2}},
+    ...                   {'num_documents': 1, 'total_len': 2, 'df': {'document': 1}}])
+    (3, 6, {'first': 1, 'document': 3})
+    """
+    num_documents = total_len = 0
+    df = {}
+    for shard in statistics:
+        num_documents += shard['num_documents']
+        total_len += shard['total_len']
+        for term, count in shard['df'].items():
+            df[term] = df.get(term, 0) + count
+    return num_documents, total_len, df
+
+
+class ShardedIndex:
+    """ Coordinate worker processes that each index and search one shard of a file. """
+
+    def __init__(self, path, shards, open_shard):
+        self.shards = []
+        self.offsets = []
+        self.lock = threading.Lock()
+        for start, end in split_lines(path, shards):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(child, open_shard, path, start, end),
+                                              daemon=True)
+            process.start()
+            child.close()
+            self.shards.append((process, parent))
+        try:
+            statistics = [self._receive(connection) for _, connection in self.shards]
+            # Local doc ids start at 0 in every shard; global ids follow the order of the file
+            offset = 0
+            for shard in statistics:
+                self.offsets.append(offset)
+                offset += shard['num_documents']
+            self.num_documents, self.total_len, self.df = merge_statistics(statistics)
+            self._broadcast('statistics', (self.num_documents, self.total_len, self.df))
+        except Exception:
+            self.close()
+            raise
+
+    @staticmethod
+    def _receive(connection):
+        result = connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _broadcast(self, command, args):
+        """ Send a command to every shard at once and return their answers in shard order. """
+        with self.lock:
+            for _, connection in self.shards:
+                connection.send((command, args))
+            return [self._receive(connection) for _, connection in self.shards]
+
+    def search_batch(self, queries, k=10):
+        """ Return the global top k (doc id, score) pairs of every query. """
+        shard_results = self._broadcast('search', (list(queries), k))
+        results = []
+        for query_id in range(len(queries)):
+            candidates = [(offset + doc_id, score) for offset, shard in zip(self.offsets, shard_results)
+                          for doc_id, score in shard[query_id]]
+            results.append(heapq.nlargest(k, candidates, key=lambda x: (x[1], -x[0])))
+        return results
+
+    def search(self, query, k=10):
+        return self.search_batch([query], k)[0]
+
+    def close(self):
+        """ Stop the worker processes. """
+        for process, connection in self.shards:
+            try:
+                connection.send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+            process.join()
+        self.shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,74 +1,436 @@
-import re
+import itertools
+import os
 import sys
+from array import array
+from bisect import bisect_left
+from functools import partial
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer  # noqa: E402
+from common.bitmap import RoaringBitmap  # noqa: E402
+from common.boolean import ListCursor, evaluate, parse, plan  # noqa: E402
+from common.index_file import IndexFile, TermMapping, is_index_file, write_index  # noqa: E402
+from common.instrumentation import begin, profile_iteration  # noqa: E402
+from common.parallel import iter_lines, map_shards  # noqa: E402
+
+
+class VariableByteCodec:
+    """ Variable-byte code: 7 bits per byte, the high bit marks the last byte of a number.
+
+    >>> codec = VariableByteCodec()
+    >>> writer = codec.writer()
+    >>> for n in (5, 130, 16384):
+    ...     writer.write(n)
+    >>> buffer = writer.getvalue()
+    >>> len(buffer)
+    6
+    >>> codec.read(buffer, 0)
+    (5, 1)
+    >>> codec.read(buffer, 1)
+    (130, 3)
+    """
+
+    name = 'vbyte'
+
+    class Writer:
+        def __init__(self):
+            self.buffer = bytearray()
+
+        def write(self, n):
+            groups = [n & 0x7f]
+            n >>= 7
+            while n:
+                groups.append(n & 0x7f)
+                n >>= 7
+            groups[0] |= 0x80
+            self.buffer.extend(reversed(groups))
+
+        def tell(self):
+            return len(self.buffer)
+
+        def getvalue(self):
+            return bytes(self.buffer)
+
+    def writer(self):
+        return self.Writer()
+
+    @staticmethod
+    def read(buffer, position):
+        """ Decode the number starting at byte position, return it with the next position. """
+        n = 0
+        while True:
+            byte = buffer[position]
+            position += 1
+            if byte & 0x80:
+                return (n << 7) | (byte & 0x7f), position
+            n = (n << 7) | byte
+
+
+class BitWriter:
+    """ Append bits to a byte buffer, most significant bit first. """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.accumulator = 0
+        self.bits = 0
+        self.position = 0
+
+    def write_bits(self, value, count):
+        self.accumulator = (self.accumulator << count) | value
+        self.bits += count
+        self.position += count
+        while self.bits >= 8:
+            self.bits -= 8
+            self.buffer.append((self.accumulator >> self.bits) & 0xff)
+        self.accumulator &= (1 << self.bits) - 1
+
+    def tell(self):
+        return self.position
+
+    def getvalue(self):
+        if self.bits:
+            return bytes(self.buffer) + bytes([(self.accumulator << (8 - self.bits)) & 0xff])
+        return bytes(self.buffer)
+
+
+def read_bits(buffer, position, count):
+    """ Read count bits starting at bit position, return the value and the next position. """
+    value = 0
+    for _ in range(count):
+        value = (value << 1) | ((buffer[position >> 3] >> (7 - (position & 7))) & 1)
+        position += 1
+    return value, position
+
+
+class EliasGammaCodec:
+    """ Elias gamma code: length-1 zero bits followed by the binary number (numbers >= 1).
+
+    >>> codec = EliasGammaCodec()
+    >>> writer = codec.writer()
+    >>> for n in (1, 2, 9):
+    ...     writer.write(n)
+    >>> writer.tell()
+    11
+    >>> codec.read(writer.getvalue(), 1)
+    (2, 4)
+    """
+
+    name = 'gamma'
+
+    class Writer(BitWriter):
+        def write(self, n):
+            length = n.bit_length()
+            self.write_bits(0, length - 1)
+            self.write_bits(n, length)
+
+    def writer(self):
+        return self.Writer()
+
+    @staticmethod
+    def read(buffer, position):
+        """ Decode the number starting at bit position, return it with the next position. """
+        zeros = 0
+        while not (buffer[position >> 3] >> (7 - (position & 7))) & 1:
+            zeros += 1
+            position += 1
+        return read_bits(buffer, position, zeros + 1)
+
+
+class EliasDeltaCodec:
+    """ Elias delta code: the gamma-coded length followed by the number without its leading bit.
+
+    >>> codec = EliasDeltaCodec()
+    >>> writer = codec.writer()
+    >>> for n in (1, 17, 1000):
+    ...     writer.write(n)
+    >>> buffer = writer.getvalue()
+    >>> codec.read(buffer, 1)
+    (17, 10)
+    >>> codec.read(buffer, 10)
+    (1000, 26)
+    """
+
+    name = 'delta'
+
+    class Writer(BitWriter):
+        def write(self, n):
+            length = n.bit_length()
+            length_bits = length.bit_length()
+            self.write_bits(0, length_bits - 1)
+            self.write_bits(length, length_bits)
+            self.write_bits(n & ((1 << (length - 1)) - 1), length - 1)
+
+    def writer(self):
+        return self.Writer()
+
+    @staticmethod
+    def read(buffer, position):
+        """ Decode the number starting at bit position, return it with the next position. """
+        length, position = EliasGammaCodec.read(buffer, position)
+        rest, position = read_bits(buffer, position, length - 1)
+        return (1 << (length - 1)) | rest, position
+
+
+CODECS = {codec.name: codec() for codec in (VariableByteCodec, EliasGammaCodec, EliasDeltaCodec)}
+
+
+class PostingList:
+    """ A sorted posting list stored as compressed doc-id gaps with skip pointers.
+
+    Every skip_interval postings (by default about the square root of the length, at least 16)
+    a skip pointer (doc id, index, position) is recorded so a cursor can jump over whole runs of
+    gaps without decoding them.
+
+    >>> postings = PostingList([3, 7, 8, 20, 21, 40], 'gamma', skip_interval=2)
+    >>> len(postings), list(postings)
+    (6, [3, 7, 8, 20, 21, 40])
+    >>> postings.skips
+    [(7, 2, 8), (20, 4, 16)]
+    >>> cursor = postings.cursor()
+    >>> cursor.next_geq(9), cursor.next_geq(40), cursor.next_geq(41)
+    (20, 40, None)
+    """
+
+    def __init__(self, doc_ids, codec='vbyte', skip_interval=None):
+        self.codec = CODECS[codec]
+        self.length = len(doc_ids)
+        if skip_interval is None:
+            skip_interval = max(int(self.length ** 0.5), 16)
+        self.skip_interval = skip_interval
+        self.skips = []
+        writer = self.codec.writer()
+        previous = 0
+        for index, doc_id in enumerate(doc_ids, 1):
+            writer.write(doc_id - previous)
+            previous = doc_id
+            if index % skip_interval == 0 and index < self.length:
+                self.skips.append((doc_id, index, writer.tell()))
+        self.data = writer.getvalue()
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        read = self.codec.read
+        data = self.data
+        position = 0
+        doc_id = 0
+        for _ in range(self.length):
+            gap, position = read(data, position)
+            doc_id += gap
+            yield doc_id
+
+    def cursor(self):
+        return PostingCursor(self)
+
+    def size_in_bytes(self):
+        """ Bytes used by the gap stream plus 3 x 4 bytes per skip pointer. """
+        return len(self.data) + 12 * len(self.skips)
+
+
+class PostingCursor:
+    """ Forward-only iterator over a PostingList that decodes lazily and follows skip pointers. """
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.skip_docs = [skip[0] for skip in postings.skips]
+        self.doc_id = 0
+        self.index = 0
+        self.position = 0
+
+    def next_geq(self, target):
+        """ Return the first doc id >= target, or None when the list is exhausted. """
+        postings = self.postings
+        if self.index > 0 and self.doc_id >= target:
+            return self.doc_id
+        # Jump to the last skip pointer before target if it lies ahead of the cursor
+        skip = bisect_left(self.skip_docs, target) - 1
+        if skip >= 0 and postings.skips[skip][1] > self.index:
+            self.doc_id, self.index, self.position = postings.skips[skip]
+        read = postings.codec.read
+        while self.index < postings.length:
+            gap, self.position = read(postings.data, self.position)
+            self.doc_id += gap
+            self.index += 1
+            if self.doc_id >= target:
+                return self.doc_id
+        return None
+
+
+def open_cursor(postings):
+    """ Cursor over a PostingList or RoaringBitmap, or over the sorted doc ids of a loaded index. """
+    return postings.cursor() if hasattr(postings, 'cursor') else ListCursor(postings)
+
+
+def intersect(posting_lists):
+    """ Intersect posting lists, decoding or reading only the shortest one completely.
+
+    >>> a = PostingList([1, 4, 9, 12, 30], 'vbyte', skip_interval=2)
+    >>> b = PostingList(list(range(2, 40, 2)), 'delta', skip_interval=3)
+    >>> intersect([a, b])
+    [4, 12, 30]
+    """
+    if not posting_lists:
+        return []
+    posting_lists = sorted(posting_lists, key=len)
+    cursors = [open_cursor(postings) for postings in posting_lists[1:]]
+    results = []
+    for doc_id in posting_lists[0]:
+        for cursor in cursors:
+            found = cursor.next_geq(doc_id)
+            if found is None:
+                return results
+            if found != doc_id:
+                break
+        else:
+            results.append(doc_id)
+    return results
+
+
+def intersect_bitmaps(bitmaps):
+    """ AND RoaringBitmaps from the smallest to the largest and return the matching ids as a set. """
+    if not bitmaps:
+        return set()
+    bitmaps = sorted(bitmaps, key=len)
+    results = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        if not results:
+            break
+        results = results & bitmap
+    return set(results)
+
+
+def index_shard(file_name, start, end, analyzer):
+    """ Index the lines of a byte range; return the line count and word -> local record ids. """
+    index = {}
+    record_id = 0
+    for line in iter_lines(file_name, start, end):
+        record_id += 1
+        for word in analyzer.tokens(line):
+            if word not in index:
+                index[word] = []
+            if index[word][-1:] != [record_id]:
+                index[word].append(record_id)
+    return record_id, index
 
 
 class InvertedIndex:
     """ A very simple inverted index. """
 
-    def __init__(self):
-        """ Create an empty inverted index. """
+    def __init__(self, analyzer=None, instrumentation=None):
+        """ Create an empty inverted index; analyzer turns lines and queries into words.
 
+        Builds, compression and searches are profiled when an Instrumentation is given.
+        """
+
+        self.analyzer = analyzer or Analyzer()
         self.postings = None  # used for compressed mode
         self.indexes = None  # used for compressed mode
+        self.indexOffsets = None  # used for compressed mode
+        self.indexCount = 0  # used for compressed mode
 
         self.invertedIndex = {}
+        self.indexFile = None  # set when the index is loaded from disk
         self.compressStatus = False
-        self.matchCount = 1
+        self.blockSize = 4
+        self.codec = 'vbyte'
+        self.instrumentation = instrumentation
 
     def read_from_txt(self, file_name):
         """ Construct index from given file
 
         >>> ii = InvertedIndex()
         >>> ii.read_from_txt('Datasets/example.txt')
-        >>> ii.invertedIndex
-        {'first': {1}, 'document': {1, 2, 3}, 'second': {2}, 'third': {3}}
+        >>> {word: list(postings) for word, postings in ii.invertedIndex.items()}
+        {'first': [1], 'document': [1, 2, 3], 'second': [2], 'third': [3]}
+        >>> ii.invertedIndex['document']
+        RoaringBitmap([1, 2, 3])
         """
+        profile = begin(self.instrumentation, 'build')
+        profile.phase('invert')
         with open(file_name, encoding="utf8") as file:
             record_id = 0
             for line in file:
                 record_id += 1
-                for word in re.split('[^a-zA-z]', line):
-                    if len(word) > 0:
-                        word = word.lower()
-                        if word not in self.invertedIndex:
-                            self.invertedIndex[word] = set()
-                        self.invertedIndex[word].add(record_id)
-
-    def _compress(self):
+                words = self.analyzer.tokens(line)
+                profile.count('tokens', len(words))
+                for word in words:
+                    if word not in self.invertedIndex:
+                        self.invertedIndex[word] = RoaringBitmap()
+                    self.invertedIndex[word].add(record_id)
+        for postings in self.invertedIndex.values():
+            postings.optimize()
+        profile.count('documents', record_id)
+        profile.count('terms', len(self.invertedIndex))
+        profile.finish()
+
+    def _compress(self, words):
+        """ Front-code the sorted words in blocks of blockSize words.
+
+        Each block is written as ',' + length + head word, followed by '*' and then '@' before
+        every other word as its full length + the suffix it does not share with the head.
+        indexOffsets keeps the position of every block so a lookup only decodes one block.
+
+        >>> ii = InvertedIndex()
+        >>> ii.blockSize = 2
+        >>> ii._compress(['auto', 'automata', 'automate', 'automatic', 'bus'])
+        >>> ii.indexes
+        ',4auto*8mata,8automate*9ic,3bus'
+        >>> list(ii.indexOffsets)
+        [0, 12, 26]
+        """
         self.indexes = ''
-        current = ''  # current input to check to other
-        index = 0
-        setCurrent = True
-        matchHistory = False
-        words = list(self.invertedIndex.keys())
-        while index < len(words):
-            if words[index] == '':  # chck for null
-                index += 1
-                continue
-            if setCurrent:  # set input for match to other
-                current = words[index]
-                self.indexes += ',' + str(len(words[index])) + words[index]
-                index += 1
-                setCurrent = False
-                continue
-            ind = -1  # match characters
-            for i in range(min(len(words[index]), len(current))):
-                if current[i] == words[index][i]:
-                    ind = i
-            if ind < self.matchCount:  # does not match
-                setCurrent = True
-                matchHistory = False
-            else:  # match
-                if matchHistory:  # first match
-                    self.indexes += '@'
-                else:  # other match
-                    self.indexes += '*'
-                    matchHistory = True
-                self.indexes += str(len(words[index])) + words[index][ind + 1:]
-                index += 1
-        self.indexes = words[1:]
+        self.indexOffsets = array('L')
+        self.indexCount = len(words)
+        for start in range(0, len(words), self.blockSize):
+            block = words[start:start + self.blockSize]
+            head = block[0]
+            self.indexOffsets.append(len(self.indexes))
+            self.indexes += ',' + str(len(head)) + head
+            for position, word in enumerate(block[1:]):
+                shared = 0
+                while shared < min(len(head), len(word)) and head[shared] == word[shared]:
+                    shared += 1
+                self.indexes += '*' if position == 0 else '@'
+                self.indexes += str(len(word)) + word[shared:]
         self.compressStatus = True
 
+    def _block_head(self, block):
+        """ Decode the head word of a block. """
+        position = self.indexOffsets[block] + 1
+        length = 0
+        while self.indexes[position].isdigit():
+            length = length * 10 + int(self.indexes[position])
+            position += 1
+        return self.indexes[position:position + length]
+
+    def _lookup(self, word):
+        """ Return the position of word in the compressed dictionary or -1.
+
+        Binary search over the block heads, then decode only the matching block.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.compress()
+        >>> ii._lookup('document'), ii._lookup('third'), ii._lookup('fourth')
+        (0, 3, -1)
+        """
+        low, high = 0, len(self.indexOffsets)
+        while low < high:
+            middle = (low + high) // 2
+            if self._block_head(middle) <= word:
+                low = middle + 1
+            else:
+                high = middle
+        block = low - 1
+        if block < 0:
+            return -1
+        end = self.indexOffsets[block + 1] if block + 1 < len(self.indexOffsets) else len(self.indexes)
+        for position, candidate in enumerate(self._decompress_block(self.indexes[self.indexOffsets[block] + 1:end])):
+            if candidate == word:
+                return block * self.blockSize + position
+        return -1
+
     def extract_d_w(self, string):
         d = ''
         w = ''
@@ -82,31 +444,160 @@ class InvertedIndex:
     def get_compress_index(self):
         return self.indexes.replace(',', '')
 
-    def _decompress(self):
-        inp = self.indexes.split(',')
-        output = []
-        for words in inp:
-            if words == "":
-                continue
-            data = words.split('*')
-            if len(data) == 1:
-                output.append(self.extract_d_w(data[0])[1])
-                continue
-            count, current = self.extract_d_w(data[0])
-            output.append(current)
+    def _decompress_block(self, block):
+        data = block.split('*')
+        current = self.extract_d_w(data[0])[1]
+        output = [current]
+        if len(data) > 1:
             for string in data[1].split('@'):
                 d, w = self.extract_d_w(string)
                 output.append(current[: (int(d) - len(w))] + w)
         return output
 
+    def _decompress(self):
+        output = []
+        for block in self.indexes.split(','):
+            if block == "":
+                continue
+            output.extend(self._decompress_block(block))
+        return output
+
     def get_decompress_index(self):
         return self._decompress()
 
-    def compress(self):
+    def compress(self, codec='vbyte'):
+        """ Compress the dictionary and store every posting set as a PostingList using codec.
+
+        With codec='roaring' the posting sets are kept as they are built, as
+        RoaringBitmaps of array and bitmap chunks that are ANDed chunk by chunk.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.compress('roaring')
+        >>> ii.search('document second'), list(ii.search_boolean('document AND NOT first'))
+        ({2}, [2, 3])
+        """
         if self.compressStatus:
             return
-        self.postings = list(self.invertedIndex.values())
-        self._compress()
+        profile = begin(self.instrumentation, 'compress', codec)
+        self.codec = codec
+        profile.phase('postings')
+        words = sorted(self.invertedIndex)
+        if codec == 'roaring':
+            self.postings = [self.invertedIndex[word] for word in words]
+        else:
+            self.postings = [PostingList(sorted(self.invertedIndex[word]), codec) for word in words]
+        profile.phase('dictionary')
+        self._compress(words)
+        profile.count('terms', len(words))
+        if profile.enabled:
+            # Sizing every posting list is only worth its cost for a profiled build
+            profile.count('postings_bytes', sum(postings.size_in_bytes() for postings in self.postings))
+        profile.finish()
+
+    def posting_stats(self):
+        """ Report size, bytes per posting and ratio against 4-byte integers for every codec and for roaring.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> stats = ii.posting_stats()
+        >>> stats['vbyte']['bytes'], stats['gamma']['bytes'], stats['vbyte']['postings']
+        (6, 4, 6)
+        >>> stats['roaring']['bytes']
+        56
+        """
+        doc_lists = [sorted(docs) for docs in self.invertedIndex.values()]
+        postings = sum(len(docs) for docs in doc_lists)
+        stats = {}
+        for name in list(CODECS) + ['roaring']:
+            if name == 'roaring':
+                size = sum(RoaringBitmap(docs).size_in_bytes() for docs in doc_lists)
+            else:
+                size = sum(PostingList(docs, name).size_in_bytes() for docs in doc_lists)
+            stats[name] = {
+                'postings': postings,
+                'bytes': size,
+                'bytes_per_posting': size / postings if postings else 0.0,
+                'compression_ratio': 4 * postings / size if size else 0.0,
+            }
+        return stats
+
+    def read_from_txt_parallel(self, file_name, workers=None):
+        """ Construct index from given file, indexing line-aligned shards in worker processes
+
+        Record ids stay global line numbers, so the result equals read_from_txt.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt_parallel('Datasets/example.txt', workers=2)
+        >>> {word: list(postings) for word, postings in ii.invertedIndex.items()}
+        {'first': [1], 'document': [1, 2, 3], 'second': [2], 'third': [3]}
+        >>> ii.invertedIndex['document']
+        RoaringBitmap([1, 2, 3])
+        """
+        # Gather the record ids of every word over the shards, then build each bitmap once
+        shard_postings = {}
+        offset = 0
+        for line_count, index in map_shards(partial(index_shard, analyzer=self.analyzer), file_name, workers):
+            for word, record_ids in index.items():
+                shard_postings.setdefault(word, []).append(array('I', map(offset.__add__, record_ids)))
+            offset += line_count
+        for word, parts in shard_postings.items():
+            # Shards are in file order, so the concatenated record ids are sorted
+            self.invertedIndex[word] = RoaringBitmap(itertools.chain.from_iterable(parts))
+
+    def save(self, path):
+        """ Write the index to path in the binary index file format.
+
+        An index compressed with codec='roaring' is written as its serialized
+        RoaringBitmaps, which load decodes back into compressed mode; any other
+        index is written as uncompressed sorted doc ids.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'example.idx')
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.save(path)
+        >>> loaded = InvertedIndex.load(path)
+        >>> sorted(loaded.invertedIndex), loaded.search('document'), list(loaded.search_boolean('document NOT first'))
+        (['document', 'first', 'second', 'third'], {1, 2, 3}, [2, 3])
+        >>> ii.compress('roaring')
+        >>> ii.save(path)
+        >>> loaded = InvertedIndex.load(path)
+        >>> loaded.compressStatus, loaded.codec, loaded.search('document second')
+        (True, 'roaring', {2})
+        """
+        words = sorted(self.invertedIndex)
+        metadata = {'analyzer': self.analyzer.config()}
+        if self.compressStatus and self.codec == 'roaring':
+            # The postings follow the sorted words; the doc id section stays empty
+            roaring = bytearray()
+            offsets = array('Q', [0])
+            for postings in self.postings:
+                roaring += postings.to_bytes()
+                offsets.append(len(roaring))
+            write_index(path, ((word, (), None) for word in words),
+                        arrays={'roaring': ('B', roaring), 'roaring_offsets': ('Q', offsets)}, metadata=metadata)
+        else:
+            write_index(path, ((word, sorted(self.invertedIndex[word]), None) for word in words), metadata=metadata)
+
+    @classmethod
+    def load(cls, path):
+        """ Open an index saved with save; postings are read lazily from the memory-mapped file.
+
+        A roaring index is decoded once into compressed mode instead.
+        """
+        ii = cls()
+        ii.indexFile = IndexFile(path)
+        ii.analyzer = Analyzer.from_config(ii.indexFile.statistics.get('analyzer'))
+        if 'roaring' in ii.indexFile.sections:
+            roaring = ii.indexFile.array('roaring')
+            offsets = ii.indexFile.array('roaring_offsets')
+            ii.invertedIndex = TermMapping(ii.indexFile, lambda position: RoaringBitmap.from_bytes(
+                roaring[offsets[position]:offsets[position + 1]]))
+            ii.compress('roaring')
+        else:
+            ii.invertedIndex = TermMapping(ii.indexFile, ii.indexFile.doc_ids)
+        return ii
 
     def search(self, search):
         """ Search with inverted indexes
@@ -116,29 +607,70 @@ class InvertedIndex:
         >>> ii.search('first')
         {1}
         """
-        search = map(lambda x: x.lower(), re.split('[^a-zA-z]', search))
+        profile = begin(self.instrumentation, 'search', search)
+        profile.phase('tokenize')
+        search = self.analyzer.tokens(search)
 
         results = set()
 
+        profile.phase('postings')
         if self.compressStatus:
+            posting_lists = []
             for key in search:
-                index = self.indexes.index(key)
+                index = self._lookup(key)
                 if index > -1:
-                    if len(results) == 0:
-                        results = set(x for x in self.postings[index])
-                    else:
-                        results.intersection_update(self.postings[index])
+                    posting_lists.append(self.postings[index])
+            profile.phase('intersect')
+            profile.count('postings_read', sum(len(postings) for postings in posting_lists))
+            if self.codec == 'roaring':
+                results = intersect_bitmaps(posting_lists)
+            else:
+                results = set(intersect(posting_lists))
         else:
-            available_keys = self.invertedIndex.keys()
-            for key in search:
-                if key in available_keys:
-                    if len(results) == 0:
-                        results = set(x for x in self.invertedIndex[key])
-                    else:
-                        results.intersection_update(self.invertedIndex[key])
+            posting_sets = [self.invertedIndex[key] for key in set(search) if key in self.invertedIndex]
+            profile.phase('intersect')
+            profile.count('postings_read', sum(len(postings) for postings in posting_sets))
+            if self.indexFile is not None:
+                # Loaded postings are sorted doc id arrays read in place from the mapped file
+                results = set(intersect(posting_sets))
+            else:
+                results = intersect_bitmaps(posting_sets)
 
+        profile.count('documents_matched', len(results))
+        profile.finish()
         return results
 
+    def search_boolean(self, query):
+        """ Search with a Boolean query of words, AND, OR, NOT and parentheses
+
+        Adjacent words are ANDed. The query is planned with the document frequencies
+        of its words and matching record ids are yielded in increasing order; in
+        compressed mode the posting lists are decoded lazily through their skip pointers
+        and otherwise the RoaringBitmaps are walked chunk by chunk.
+        A profiled search finishes its profile when the results are exhausted or closed.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.compress()
+        >>> list(ii.search_boolean('document AND NOT (first OR third)')), list(ii.search_boolean('first OR third'))
+        ([2], [1, 3])
+        """
+        profile = begin(self.instrumentation, 'search', query)
+        profile.phase('plan')
+        tree = plan(parse(query, self.analyzer), self._document_frequency)
+        return profile_iteration(profile, evaluate(tree, self._cursor), 'evaluate', 'documents_matched')
+
+    def _document_frequency(self, word):
+        if self.compressStatus:
+            index = self._lookup(word)
+            return len(self.postings[index]) if index > -1 else 0
+        return len(self.invertedIndex[word]) if word in self.invertedIndex else 0
+
+    def _cursor(self, word):
+        if self.compressStatus:
+            return self.postings[self._lookup(word)].cursor()
+        return open_cursor(self.invertedIndex[word])
+
 
 if __name__ == '__main__':
     if len(sys.argv) != 2:
@@ -147,16 +679,21 @@ if __name__ == '__main__':
 
     filename = sys.argv[1]
 
-    ii = InvertedIndex()
-    ii.read_from_txt(filename)
+    if is_index_file(filename):
+        ii = InvertedIndex.load(filename)
+    else:
+        ii = InvertedIndex()
+        ii.read_from_txt(filename)
 
     print('Search [0]')
     print('See inverted index [1]')
     print('compress indexes [2]')
     print('See compressed indexes [3]')
     print('See uncompressed indexes [4]')
+    print('See posting compression stats [5]')
+    print('Save index [6]')
     status = input('Choose action or any key to exit: ')
-    while status.isdigit() and 0 <= int(status) <= 4:
+    while status.isdigit() and 0 <= int(status) <= 6:
         if status == '0':
             for doc in ii.search(input('search: ')):
                 print(doc)
@@ -170,6 +707,14 @@ if __name__ == '__main__':
             print('Successfully compressed')
         elif status == '3':
             print(ii.get_compress_index())
+        elif status == '6':
+            ii.save(input('file name: '))
+            print('Successfully saved')
+        elif status == '5':
+            print('codec'.ljust(10), 'bytes'.ljust(10), 'bytes/posting'.ljust(15), 'ratio')
+            for name, stats in ii.posting_stats().items():
+                print(name.ljust(10), str(stats['bytes']).ljust(10),
+                      ('%.3f' % stats['bytes_per_posting']).ljust(15), '%.2f' % stats['compression_ratio'])
         else:
             print(ii.get_decompress_index())
 
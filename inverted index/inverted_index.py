@@ -1,33 +1,420 @@
-import re
+import heapq
+import itertools
+import os
+import struct
 import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left
+from functools import partial
+from operator import itemgetter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer  # noqa: E402
+from common.bitmap import RoaringBitmap  # noqa: E402
+from common.boolean import ListCursor, evaluate, parse, plan  # noqa: E402
+from common.index_file import IndexFile, TermMapping, is_index_file, write_index  # noqa: E402
+from common.instrumentation import begin, profile_iteration  # noqa: E402
+from common.parallel import iter_lines, map_shards  # noqa: E402
+from common.positions import decode_positions, encode_positions, min_span, phrase_starts  # noqa: E402
+
+
+# Rough CPython sizes used to estimate the memory of a SPIMI block
+TERM_BYTES = 150  # dictionary slot, string header and list header of a new term
+POSTING_BYTES = 40  # list slot and int object of a posting
+
+
+def read_records(file_name, analyzer):
+    """ Yield (record id, words) for every line of a file, one line at a time. """
+    with open(file_name, encoding="utf8") as file:
+        for record_id, line in enumerate(file, 1):
+            yield record_id, analyzer.tokens(line)
+
+
+# Intersect by galloping when one list is this many times longer than the other
+GALLOP_RATIO = 8
+
+
+def gallop_intersect(small, large):
+    """ Intersect sorted lists by exponential search of every element of small in large.
+
+    >>> gallop_intersect([3, 40, 90], list(range(0, 100, 2)))
+    [40, 90]
+    """
+    results = []
+    low = 0
+    size = len(large)
+    for doc in small:
+        # Double the step until large[low + step] >= doc, then binary search that range
+        step = 1
+        while low + step < size and large[low + step] < doc:
+            step *= 2
+        low = bisect_left(large, doc, low, min(low + step + 1, size))
+        if low == size:
+            break
+        if large[low] == doc:
+            results.append(doc)
+    return results
+
+
+def merge_intersect(first, second):
+    """ Intersect sorted lists of similar length with a linear merge.
+
+    >>> merge_intersect([1, 3, 5, 7], [2, 3, 4, 7, 9])
+    [3, 7]
+    """
+    results = []
+    i = j = 0
+    while i < len(first) and j < len(second):
+        if first[i] == second[j]:
+            results.append(first[i])
+            i += 1
+            j += 1
+        elif first[i] < second[j]:
+            i += 1
+        else:
+            j += 1
+    return results
+
+
+def intersect(first, second):
+    """ Intersect two posting lists, galloping when their lengths are very different.
+
+    The RoaringBitmaps built in memory are ANDed chunk by chunk; the sorted doc id
+    arrays of a loaded index are intersected in place, without copying them.
+    """
+    if isinstance(first, RoaringBitmap):
+        return first & second
+    if len(first) > len(second):
+        first, second = second, first
+    if len(first) * GALLOP_RATIO < len(second):
+        return gallop_intersect(first, second)
+    return merge_intersect(first, second)
+
+
+RUN_ENTRY = struct.Struct('<II')  # word length and number of postings of a run entry
+# Most run files merged at once, which keeps the open files well below the usual descriptor limits
+MERGE_FAN_IN = 64
+
+
+def _write_entries(entries, directory):
+    """ Write (word, doc ids) entries in word order to a new run file. """
+    handle, path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(handle, 'wb') as run:
+        for word, docs in entries:
+            encoded = word.encode('utf8')
+            run.write(RUN_ENTRY.pack(len(encoded), len(docs)))
+            run.write(encoded)
+            array('I', docs).tofile(run)
+    return path
+
+
+def _write_run(block, directory):
+    """ Write a block sorted by word to a run file of (word, doc ids) entries. """
+    return _write_entries(((word, block[word]) for word in sorted(block)), directory)
+
+
+def _read_run(run):
+    """ Yield (word, run, position, count) for every entry; postings are read only when merged. """
+    position = 0
+    while True:
+        run.seek(position)
+        header = run.read(RUN_ENTRY.size)
+        if not header:
+            return
+        length, count = RUN_ENTRY.unpack(header)
+        word = run.read(length).decode('utf8')
+        position += RUN_ENTRY.size + length
+        yield word, run, position, count
+        position += 4 * count
+
+
+def _merge_runs(paths):
+    """ k-way merge run files into (word, doc ids) in word order.
+
+    Runs hold consecutive ranges of records and heapq.merge keeps the run order
+    for equal words, so concatenated postings stay sorted.
+    """
+    runs = [open(path, 'rb') for path in paths]
+    try:
+        merged = heapq.merge(*(_read_run(run) for run in runs), key=itemgetter(0))
+        for word, group in itertools.groupby(merged, key=itemgetter(0)):
+            docs = array('I')
+            for _, run, position, count in group:
+                run.seek(position)
+                docs.fromfile(run, count)
+            yield word, docs
+    finally:
+        for run in runs:
+            run.close()
+
+
+def index_shard(file_name, start, end, analyzer):
+    """ Index the lines of a byte range; return the line count and word -> local record ids. """
+    index = {}
+    record_id = 0
+    for line in iter_lines(file_name, start, end):
+        record_id += 1
+        for word in analyzer.tokens(line):
+            if word not in index:
+                index[word] = []
+            if index[word][-1:] != [record_id]:
+                index[word].append(record_id)
+    return record_id, index
 
 
 class InvertedIndex:
     """ A very simple inverted index. """
 
-    def __init__(self):
-        """ Create an empty inverted index. """
+    def __init__(self, positional=False, analyzer=None, instrumentation=None):
+        """ Create an empty inverted index, recording word positions when positional is set.
+
+        analyzer turns lines and queries into words; the default one splits on non-letters.
+        Builds and searches are profiled when an Instrumentation is given.
+        """
 
         self.invertedIndex = {}
+        self.analyzer = analyzer or Analyzer()
+        self.positional = positional
+        self.positions = {}  # word -> {record id: compressed positions} in positional mode
+        self.indexFile = None  # set when the index is loaded from disk
+        self.buildStats = None  # set by read_from_txt_spimi
+        self.instrumentation = instrumentation
 
     def read_from_txt(self, file_name):
         """ Construct index from given file
 
         >>> ii = InvertedIndex()
         >>> ii.read_from_txt('Datasets/example.txt')
-        >>> ii.invertedIndex
-        {'first': {1}, 'document': {1, 2, 3}, 'second': {2}, 'third': {3}}
+        >>> {word: list(postings) for word, postings in ii.invertedIndex.items()}
+        {'first': [1], 'document': [1, 2, 3], 'second': [2], 'third': [3]}
+        >>> ii.invertedIndex['document']
+        RoaringBitmap([1, 2, 3])
         """
+        profile = begin(self.instrumentation, 'build')
+        profile.phase('invert')
         with open(file_name, encoding="utf8") as file:
             record_id = 0
             for line in file:
                 record_id += 1
-                for word in re.split('[^a-zA-z]', line):
-                    if len(word) > 0:
-                        word = word.lower()
-                        if word not in self.invertedIndex:
-                            self.invertedIndex[word] = set()
-                        self.invertedIndex[word].add(record_id)
+                line_positions = {}
+                words = self.analyzer.tokens(line)
+                profile.count('tokens', len(words))
+                for position, word in enumerate(words):
+                    if word not in self.invertedIndex:
+                        self.invertedIndex[word] = RoaringBitmap()
+                    self.invertedIndex[word].add(record_id)
+                    if self.positional:
+                        line_positions.setdefault(word, []).append(position)
+                for word, positions in line_positions.items():
+                    self.positions.setdefault(word, {})[record_id] = encode_positions(positions)
+        for postings in self.invertedIndex.values():
+            postings.optimize()
+        profile.count('documents', record_id)
+        profile.count('terms', len(self.invertedIndex))
+        profile.finish()
+
+    def word_positions(self, word, record_id):
+        """ Return the positions of word in a record of a positional index
+
+        >>> ii = InvertedIndex(positional=True)
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.word_positions('document', 2)
+        [1]
+        """
+        return decode_positions(self.positions[word][record_id])
+
+    def _require_positions(self):
+        if not self.positional:
+            raise ValueError('phrase and proximity queries need an index built by read_from_txt with positional=True')
+
+    def _candidates(self, words):
+        """ Records that contain every word, or an empty list when a word is unknown. """
+        if not words or any(word not in self.invertedIndex for word in words):
+            return []
+        posting_lists = sorted((self.invertedIndex[word] for word in set(words)), key=len)
+        results = posting_lists[0]
+        for postings in posting_lists[1:]:
+            results = intersect(results, postings)
+            if not results:
+                break
+        return results
+
+    def search_phrase(self, phrase):
+        """ Search records containing the words of phrase next to each other, in order
+
+        >>> ii = InvertedIndex(positional=True)
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.search_phrase('second document'), ii.search_phrase('document second')
+        ({2}, set())
+        >>> InvertedIndex().search_phrase('second document')
+        Traceback (most recent call last):
+        ...
+        ValueError: phrase and proximity queries need an index built by read_from_txt with positional=True
+        """
+        self._require_positions()
+        words = self.analyzer.tokens(phrase)
+        return set(record_id for record_id in self._candidates(words)
+                   if phrase_starts([self.word_positions(word, record_id) for word in words]))
+
+    def search_proximity(self, query, distance):
+        """ Search records where all words of query occur within distance words of each other
+
+        >>> ii = InvertedIndex(positional=True)
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.search_proximity('document third', 1), ii.search_proximity('first second', 5)
+        ({3}, set())
+        """
+        self._require_positions()
+        words = list(dict.fromkeys(self.analyzer.tokens(query)))
+        return set(record_id for record_id in self._candidates(words)
+                   if min_span([self.word_positions(word, record_id) for word in words]) <= distance)
+
+    def read_from_txt_spimi(self, file_name, index_path, memory_budget=64 * 2 ** 20, temp_dir=None,
+                            fan_in=MERGE_FAN_IN):
+        """ Construct index from given file with single-pass in-memory indexing (SPIMI)
+
+        Records are streamed into a block until its estimated size reaches
+        memory_budget bytes, then the block is sorted and spilled to a run file.
+        The runs are k-way merged into an index file at index_path, which is then
+        loaded, so peak memory depends on the budget and not on the corpus size.
+        At most fan_in runs are open at once: while there are more, consecutive
+        groups of fan_in runs are first merged into intermediate runs.
+        Returns the build statistics, also kept in buildStats.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'example.idx')
+        >>> ii = InvertedIndex()
+        >>> stats = ii.read_from_txt_spimi('Datasets/example.txt', path, memory_budget=400)
+        >>> stats['runs'], stats['records'], stats['postings']
+        (2, 3, 6)
+        >>> {word: list(docs) for word, docs in ii.invertedIndex.items()}
+        {'document': [1, 2, 3], 'first': [1], 'second': [2], 'third': [3]}
+        >>> stats = ii.read_from_txt_spimi('Datasets/example.txt', path, memory_budget=1, fan_in=2)
+        >>> stats['runs'], stats['merge_passes'], list(ii.invertedIndex['document'])
+        (3, 1, [1, 2, 3])
+        """
+        if self.positional:
+            raise ValueError('SPIMI builds do not record positions; use read_from_txt for a positional index')
+        if fan_in < 2:
+            raise ValueError('fan_in must be at least 2')
+        start = time.perf_counter()
+        runs = []
+        # Every run file written, spilled or intermediate, removed once merged or on failure
+        run_files = []
+        merge_passes = 0
+        block = {}
+        block_bytes = 0
+        records = tokens = postings = 0
+        try:
+            for record_id, words in read_records(file_name, self.analyzer):
+                records += 1
+                tokens += len(words)
+                for word in words:
+                    docs = block.get(word)
+                    if docs is None:
+                        block[word] = docs = []
+                        block_bytes += TERM_BYTES + len(word)
+                    if not docs or docs[-1] != record_id:
+                        docs.append(record_id)
+                        block_bytes += POSTING_BYTES
+                        postings += 1
+                if block_bytes >= memory_budget:
+                    runs.append(_write_run(block, temp_dir))
+                    run_files.append(runs[-1])
+                    block = {}
+                    block_bytes = 0
+            if block:
+                runs.append(_write_run(block, temp_dir))
+                run_files.append(runs[-1])
+            spilled = len(runs)
+            while len(runs) > fan_in:
+                # Merging consecutive runs keeps the runs in record order
+                merged = []
+                for first in range(0, len(runs), fan_in):
+                    group = runs[first:first + fan_in]
+                    merged.append(_write_entries(_merge_runs(group), temp_dir))
+                    run_files.append(merged[-1])
+                    for run in group:
+                        os.remove(run)
+                runs = merged
+                merge_passes += 1
+            write_index(index_path, ((word, docs, None) for word, docs in _merge_runs(runs)),
+                        metadata={'analyzer': self.analyzer.config()})
+        finally:
+            for run in run_files:
+                if os.path.exists(run):
+                    os.remove(run)
+        self._open(index_path)
+        seconds = time.perf_counter() - start
+        self.buildStats = {
+            'records': records,
+            'tokens': tokens,
+            'postings': postings,
+            'terms': self.indexFile.term_count,
+            'runs': spilled,
+            'merge_passes': merge_passes,
+            'seconds': seconds,
+            'tokens_per_second': tokens / seconds if seconds else 0.0,
+        }
+        return self.buildStats
+
+    def read_from_txt_parallel(self, file_name, workers=None):
+        """ Construct index from given file, indexing line-aligned shards in worker processes
+
+        Record ids stay global line numbers, so the result equals read_from_txt.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt_parallel('Datasets/example.txt', workers=2)
+        >>> {word: list(postings) for word, postings in ii.invertedIndex.items()}
+        {'first': [1], 'document': [1, 2, 3], 'second': [2], 'third': [3]}
+        >>> ii.invertedIndex['document']
+        RoaringBitmap([1, 2, 3])
+        """
+        if self.positional:
+            raise ValueError('parallel builds do not record positions; use read_from_txt for a positional index')
+        # Gather the record ids of every word over the shards, then build each bitmap once
+        shard_postings = {}
+        offset = 0
+        for line_count, index in map_shards(partial(index_shard, analyzer=self.analyzer), file_name, workers):
+            for word, record_ids in index.items():
+                shard_postings.setdefault(word, []).append(array('I', map(offset.__add__, record_ids)))
+            offset += line_count
+        for word, parts in shard_postings.items():
+            # Shards are in file order, so the concatenated record ids are sorted
+            self.invertedIndex[word] = RoaringBitmap(itertools.chain.from_iterable(parts))
+
+    def save(self, path):
+        """ Write the uncompressed index to path in the binary index file format.
+
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'example.idx')
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> ii.save(path)
+        >>> loaded = InvertedIndex.load(path)
+        >>> sorted(loaded.invertedIndex), loaded.search('document'), list(loaded.search_boolean('document NOT first'))
+        (['document', 'first', 'second', 'third'], {1, 2, 3}, [2, 3])
+        """
+        words = sorted(self.invertedIndex)
+        write_index(path, ((word, self.invertedIndex[word], None) for word in words),
+                    metadata={'analyzer': self.analyzer.config()})
+
+    @classmethod
+    def load(cls, path):
+        """ Open an index saved with save; postings are read lazily from the memory-mapped file.
+
+        Positions are not saved, so a loaded index answers no phrase or proximity queries.
+        """
+        ii = cls()
+        ii._open(path)
+        return ii
+
+    def _open(self, path):
+        self.indexFile = IndexFile(path)
+        self.invertedIndex = TermMapping(self.indexFile, self.indexFile.doc_ids)
+        self.analyzer = Analyzer.from_config(self.indexFile.statistics.get('analyzer'))
 
     def search(self, search):
         """ Search with inverted indexes
@@ -37,39 +424,84 @@ class InvertedIndex:
         >>> ii.search('first')
         {1}
         """
-        search = map(lambda x: x.lower(), re.split('[^a-zA-z]', search))
-
-        results = set()
-        available_keys = self.invertedIndex.keys()
-        for key in search:
-            if key in available_keys:
-                if len(results) == 0:
-                    results = set(x for x in self.invertedIndex[key])
-                else:
-                    results.intersection_update(self.invertedIndex[key])
-        return results
+        profile = begin(self.instrumentation, 'search', search)
+        profile.phase('tokenize')
+        search = self.analyzer.tokens(search)
+
+        # Unknown words are ignored; the rest are intersected from the rarest to the most frequent
+        profile.phase('postings')
+        posting_lists = sorted((self.invertedIndex[key] for key in set(search) if key in self.invertedIndex), key=len)
+        if not posting_lists:
+            profile.finish()
+            return set()
+        profile.phase('intersect')
+        results = posting_lists[0]
+        profile.count('postings_read', len(results))
+        for postings in posting_lists[1:]:
+            profile.count('postings_read', len(postings))
+            results = intersect(results, postings)
+            if not results:
+                break
+        profile.count('documents_matched', len(results))
+        profile.finish()
+        return set(results)
+
+    def search_boolean(self, query):
+        """ Search with a Boolean query of words, AND, OR, NOT and parentheses
+
+        Adjacent words are ANDed. The query is planned with the document frequencies
+        of its words and matching record ids are yielded in increasing order.
+        A profiled search finishes its profile when the results are exhausted or closed.
+
+        >>> ii = InvertedIndex()
+        >>> ii.read_from_txt('Datasets/example.txt')
+        >>> list(ii.search_boolean('document AND NOT (first OR third)')), list(ii.search_boolean('first OR third'))
+        ([2], [1, 3])
+        """
+        profile = begin(self.instrumentation, 'search', query)
+        profile.phase('plan')
+        tree = plan(parse(query, self.analyzer), self._document_frequency)
+        return profile_iteration(profile, evaluate(tree, self._cursor), 'evaluate', 'documents_matched')
+
+    def _document_frequency(self, word):
+        return len(self.invertedIndex[word]) if word in self.invertedIndex else 0
+
+    def _cursor(self, word):
+        postings = self.invertedIndex[word]
+        return postings.cursor() if isinstance(postings, RoaringBitmap) else ListCursor(postings)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage: python BM25_ranking.py [file_name]")
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python inverted_index.py [file_name] [spimi_index_file]")
         sys.exit(1)
 
     filename = sys.argv[1]
 
-    ii = InvertedIndex()
-    ii.read_from_txt(filename)
+    if len(sys.argv) == 3:
+        ii = InvertedIndex()
+        stats = ii.read_from_txt_spimi(filename, sys.argv[2])
+        print('Built %(terms)d terms from %(records)d records with %(runs)d spilled runs '
+              'in %(seconds).2fs (%(tokens_per_second).0f tokens/s)' % stats)
+    elif is_index_file(filename):
+        ii = InvertedIndex.load(filename)
+    else:
+        ii = InvertedIndex()
+        ii.read_from_txt(filename)
 
-    status = input('See inverted index [0] or search [1]: ')
-    while status.isdigit() and (int(status) == 0 or int(status) == 1):
+    status = input('See inverted index [0] or search [1] or save index [2]: ')
+    while status.isdigit() and 0 <= int(status) <= 2:
         if status == '0':
             print('inverted index')
             print('input'.ljust(30), 'repeats'.ljust(10), 'documents')
             for word, indexes in ii.invertedIndex.items():
-                print(word.ljust(30), str(len(indexes)).ljust(10), indexes)
-        else:
+                print(word.ljust(30), str(len(indexes)).ljust(10), list(indexes))
+        elif status == '1':
             for doc in ii.search(input('search: ')):
                 print(doc)
+        else:
+            ii.save(input('file name: '))
+            print('Successfully saved')
 
-        status = input('See inverted index [0] or search [1] or any key to exit: ')
+        status = input('See inverted index [0] or search [1] or save index [2] or any key to exit: ')
     print('Bye')
\ No newline at end of file
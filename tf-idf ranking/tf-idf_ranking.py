@@ -1,18 +1,42 @@
 # Import necessary modules
-import re
+import os
 import sys
 import math
+import heapq
+import time
 from collections import defaultdict
+from operator import itemgetter
+
+# Make the shared modules at the repository root importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer  # noqa: E402
+from common.cache import QueryCache  # noqa: E402
+from common.instrumentation import begin  # noqa: E402
+
+# Number of postings scored between two checks of the time budget of an impact-ordered ranking
+BUDGET_CHECK_INTERVAL = 1024
 
 
 # Define a class for the Inverted Index
 class InvertedIndex:
-    def __init__(self):
+    def __init__(self, instrumentation=None):
         # Initialize an empty inverted index (a dictionary where each key is a term and the value is a list of
         # document IDs)
         self.index = defaultdict(list)
         # Initialize an empty dictionary to store the IDF (Inverse Document Frequency) values for each term
         self.idf = {}
+        # Count the documents added to the index
+        self.num_documents = 0
+        # The impact-ordered postings (term -> (impact, document IDs)) and the score of one impact unit,
+        # set by calculate_impacts
+        self.impacts = None
+        self.impact_scale = 0.0
+        # Count the changes of the index; cached rankings of an older generation are discarded
+        self.generation = 0
+        # Cache the rankings of frequent queries
+        self.cache = QueryCache()
+        # Profile rankings and IDF computations when an Instrumentation is given
+        self.instrumentation = instrumentation
 
     # Method to add a document to the index
     def add_document(self, doc_id, terms):
@@ -20,11 +44,17 @@ class InvertedIndex:
         for term in set(terms):
             # Add the document ID to the list of document IDs for the term
             self.index[term].append(doc_id)
+        # Count the document
+        self.num_documents += 1
+        # The cached rankings are out of date
+        self.generation += 1
 
     # Method to calculate the IDF values for each term
     def calculate_idf(self):
-        # Get the total number of documents (i.e., the number of unique terms)
-        N = len(self.index)
+        profile = begin(self.instrumentation, 'build')
+        profile.phase('idf')
+        # Get the total number of documents
+        N = self.num_documents
         # Iterate over each term in the index
         for term, doc_ids in self.index.items():
             # Calculate the document frequency (DF) for the term
@@ -33,28 +63,127 @@ class InvertedIndex:
             idf = math.log(N / df)
             # Store the IDF value in the idf dictionary
             self.idf[term] = idf
+        profile.count('terms', len(self.idf))
+        profile.finish()
+        # The cached rankings are out of date
+        self.generation += 1
+
+    # Method to build the impact-ordered postings used by rank_by_impact
+    def calculate_impacts(self, bits=8):
+        # Quantize the score of every posting to an integer impact between 1 and 2 ** bits - 1, where the
+        # highest idf gets the highest impact; a document gets the idf of a term it contains, so all
+        # postings of a term share one impact, and postings that score 0 are left out
+        levels = 2 ** bits - 1
+        top = max(self.idf.values(), default=0.0)
+        self.impact_scale = top / levels if top > 0 else 0.0
+        self.impacts = {}
+        for term, doc_ids in self.index.items():
+            if self.idf.get(term, 0.0) <= 0 or not self.impact_scale:
+                continue
+            impact = max(1, round(self.idf[term] / self.impact_scale))
+            self.impacts[term] = (impact, list(doc_ids))
+        # The cached rankings are out of date
+        self.generation += 1
 
     # Method to rank documents based on a query
     def rank_documents(self, query_terms):
+        # Keep the terms, which may be given as a generator, for the cache key and the scoring
+        query_terms = list(query_terms)
+        profile = begin(self.instrumentation, 'search', query_terms)
+        # Return the cached ranking of a query seen since the index last changed
+        profile.phase('cache')
+        key = (tuple(query_terms), None)
+        ranked = self.cache.results.get(key, self.generation)
+        if ranked is not None:
+            profile.count('cache_hits')
+            profile.finish()
+            return list(ranked)
+        profile.count('cache_misses')
+        profile.phase('score')
         # Initialize a dictionary to store the scores for each document
         scores = defaultdict(float)
         # Iterate over each term in the query
         for term in query_terms:
             # Check if the term is in the index (i.e., if it's a valid term)
             if term in self.idf:
+                profile.count('postings_read', len(self.index[term]))
                 # Iterate over each document ID that contains the term
                 for doc_id in self.index[term]:
                     # Add the IDF value of the term to the score of the document
                     scores[doc_id] += self.idf[term]
-        # Return a sorted list of documents by their scores in descending order
-        return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        # Sort the documents by their scores in descending order and cache the ranking
+        profile.phase('sort')
+        profile.count('documents_scored', len(scores))
+        ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        self.cache.results.put(key, self.generation, ranked)
+        profile.finish()
+        return list(ranked)
+
+    # Method to rank documents score-at-a-time over the impact-ordered postings
+    def rank_by_impact(self, query_terms, k=None, max_postings=None, max_seconds=None):
+        # The postings of the query terms are scored from the highest impact down. Scoring stops once
+        # max_postings postings were read or max_seconds passed, so the ranking is approximate but its
+        # cost is bounded; without a budget it matches rank_documents up to the quantization
+        if self.impacts is None:
+            raise ValueError('calculate_impacts must be called before ranking by impact')
+        query_terms = list(query_terms)
+        profile = begin(self.instrumentation, 'search', query_terms)
+        # Return the cached ranking of a query seen since the index last changed; rankings cut by the
+        # time budget depend on the machine and are not cached
+        profile.phase('cache')
+        key = (tuple(query_terms), ('impact', k, max_postings))
+        if max_seconds is None:
+            ranked = self.cache.results.get(key, self.generation)
+            if ranked is not None:
+                profile.count('cache_hits')
+                profile.finish()
+                return list(ranked)
+            profile.count('cache_misses')
+        profile.phase('score')
+        deadline = time.perf_counter() + max_seconds if max_seconds is not None else None
+        budget = max_postings if max_postings is not None else math.inf
+        # Order the postings of the query terms by decreasing impact
+        segments = sorted((self.impacts[term] for term in query_terms if term in self.impacts),
+                          key=itemgetter(0), reverse=True)
+        # Accumulate integer impacts per document
+        accumulators = defaultdict(int)
+        read = 0
+        exhausted = False
+        for impact, doc_ids in segments:
+            for start in range(0, len(doc_ids), BUDGET_CHECK_INTERVAL):
+                if read >= budget or (deadline is not None and time.perf_counter() >= deadline):
+                    exhausted = True
+                    break
+                end = min(start + BUDGET_CHECK_INTERVAL, len(doc_ids), start + budget - read)
+                for doc_id in doc_ids[start:end]:
+                    accumulators[doc_id] += impact
+                read += end - start
+            if exhausted:
+                break
+        profile.count('postings_read', read)
+        profile.count('postings_skipped', sum(len(doc_ids) for _, doc_ids in segments) - read)
+        profile.count('budget_exhausted', int(exhausted))
+        # Sort the documents by their scores in descending order and cache the ranking
+        profile.phase('sort')
+        profile.count('documents_scored', len(accumulators))
+        scale = self.impact_scale
+        if k is None:
+            ranked = sorted(((doc_id, impact * scale) for doc_id, impact in accumulators.items()),
+                            key=lambda x: x[1], reverse=True)
+        else:
+            ranked = [(doc_id, impact * scale) for doc_id, impact in
+                      heapq.nlargest(k, accumulators.items(), key=itemgetter(1))]
+        if max_seconds is None:
+            self.cache.results.put(key, self.generation, ranked)
+        profile.finish()
+        return list(ranked)
 
 
 # Usage
 if __name__ == '__main__':
     # Check if the correct number of command-line arguments are provided
-    if len(sys.argv) != 2:
-        print("Usage: python tf-idf-cosine_ranking.py [file_name]")
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python tf-idf_ranking.py [file_name] [max_postings]")
         sys.exit(1)
 
     # Get the filename from the command-line argument
@@ -63,24 +192,35 @@ if __name__ == '__main__':
     # Create an instance of the InvertedIndex class
     index = InvertedIndex()
 
+    # Create the analyzer that splits text into lowercase terms
+    analyzer = Analyzer()
+
     # Add documents from the file to the index
     with open(filename, encoding="utf8") as file:
         record_id = 0
         for line in file:
             record_id += 1
-            # Split the line into terms using a regular expression and convert to lowercase
-            terms = re.split('[^a-zA-z]', line.lower())
+            # Split the line into lowercase terms
+            terms = analyzer.tokens(line)
             # Add the document to the index
             index.add_document(record_id, terms)
 
     # Calculate the IDF values for each term
     index.calculate_idf()
 
+    # Rank score-at-a-time over impact-ordered postings when a postings budget is given
+    max_postings = int(sys.argv[2]) if len(sys.argv) == 3 else None
+    if max_postings is not None:
+        index.calculate_impacts()
+
     # Prompt the user to enter a query
-    query = re.split('[^a-zA-z]', input('Search: ').lower())
+    query = analyzer.tokens(input('Search: '))
 
     # Rank documents for the query
-    ranked_docs = index.rank_documents(query)
+    if max_postings is not None:
+        ranked_docs = index.rank_by_impact(query, max_postings=max_postings)
+    else:
+        ranked_docs = index.rank_documents(query)
 
     # Print the search results
     print(f"Search results for query '{' '.join(query)}':")
@@ -1,15 +1,82 @@
 """
 Importing necessary libraries:
-    - re for regular expressions
+    - os for locating the shared modules
     - sys for system-specific parameters and functions
     - math for mathematical functions
+    - heapq for top-k selection
+    - array for the compact per-term postings and per-document arrays
     - collections for data structures like defaultdict
+    - functools for binding the analyzer of the shard workers
+    - numpy (optional) for the sparse-matrix backend
+    - common.analysis for tokenizing documents and interning terms to integer ids
+    - common.cache for the query result cache
+    - common.instrumentation for optional per-query and per-build profiling
+    - common.index_file for the memory-mapped on-disk format
+    - common.parallel for building the index in worker processes
+    - common.server for serving queries over the network
+    - common.sharding for searching shards of a collection in worker processes
 """
 
-import re
+import os
 import sys
 import math
+import heapq
+from array import array
 from collections import defaultdict
+from functools import partial
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.analysis import Analyzer, Vocabulary  # noqa: E402
+from common.cache import QueryCache  # noqa: E402
+from common.index_file import IndexFile, TermMapping, is_index_file, write_index  # noqa: E402
+from common.instrumentation import begin  # noqa: E402
+from common.parallel import iter_lines, map_shards  # noqa: E402
+from common.server import serve  # noqa: E402
+from common.sharding import ShardedIndex  # noqa: E402
+
+try:
+    import numpy as np
+except ImportError:  # the sparse backend is unavailable without numpy
+    np = None
+
+"""
+Count the terms of every document into per-term arrays of document ids, starting at 0, and counts;
+terms are interned to dense ids while counting and the tokens of a document are dropped once counted
+"""
+def count_terms(documents, analyzer):
+    vocabulary = Vocabulary()
+    doc_lengths = array('I')
+    term_docs = []
+    term_counts = []
+    for doc_id, document in enumerate(documents):
+        term_ids = analyzer.term_ids(document, vocabulary)
+        doc_lengths.append(len(term_ids))
+        for _ in range(len(term_docs), len(vocabulary)):
+            term_docs.append(array('I'))
+            term_counts.append(array('I'))
+        token_counts = defaultdict(int)
+        for term_id in term_ids:
+            token_counts[term_id] += 1
+        for term_id, count in token_counts.items():
+            term_docs[term_id].append(doc_id)
+            term_counts[term_id].append(count)
+    tf = {term: (doc_ids, counts) for term, doc_ids, counts in zip(vocabulary.terms, term_docs, term_counts)}
+    return doc_lengths, tf
+
+
+"""
+Count the terms of the lines of a byte range in a worker process
+"""
+def count_shard(filename, start, end, analyzer):
+    return count_terms(iter_lines(filename, start, end), analyzer)
+
+
+"""
+Build the index of one line-aligned byte range of a file in a worker process of a sharded search
+"""
+def open_shard(filename, start, end):
+    return InvertedIndex([line.strip() for line in iter_lines(filename, start, end)])
+
 
 """
 Class InvertedIndex: represents an inverted index data structure
@@ -17,114 +84,434 @@ Class InvertedIndex: represents an inverted index data structure
 """
 
 class InvertedIndex:
-    def __init__(self, documents):
+    def __init__(self, documents, analyzer=None, instrumentation=None):
         # Initialize the InvertedIndex object
         self.num_documents = len(documents)  # number of documents
-        self.tokenized_documents = [self._preprocess(doc) for doc in documents]  # tokenize each document
-        self.inverted_index = defaultdict(list)  # inverted index
-        self.tf = defaultdict(lambda: defaultdict(int))  # term frequency (document -> term -> count)
-        self.df = defaultdict(int)  # document frequency (term -> count)
-        self.tfidf = defaultdict(lambda: defaultdict(float))  # TF-IDF (document -> term -> score)
-        self._build_index()  # build the index
-        self._tf_df()  # compute term frequencies and document frequencies
-        self._compute_tfidf()  # compute TF-IDF scores
+        self.analyzer = analyzer or Analyzer()  # turns documents and queries into tokens
+        self.instrumentation = instrumentation  # profiles searches and builds when given
+        profile = begin(instrumentation, 'build')
+        self.doc_lengths = array('I')  # number of tokens per document
+        self.tf = {}  # term frequency (term -> (document ids, counts) arrays)
+        self.df = {}  # document frequency (term -> count)
+        self.doc_norms = array('d')  # magnitude of each document TF-IDF vector
+        self.postings = {}  # term -> (document ids, TF-IDF scores) arrays, sharing the document ids of tf
+        self.index_file = None  # memory-mapped index file when loaded from disk
+        self.generation = 0  # number of changes of the index, used to invalidate the caches
+        self.cache = QueryCache()  # results of frequent queries
+        profile.phase('invert')
+        self._build_index(documents)  # build the term frequencies and document frequencies
+        profile.phase('weights')
+        self._compute_postings()  # compute term-major TF-IDF postings
+        self._compute_norms()  # compute document magnitudes
+        profile.count('documents', self.num_documents)
+        profile.count('tokens', sum(self.doc_lengths))
+        profile.count('terms', len(self.postings))
+        profile.finish()
+
+    """
+    Build the index of a file with one line per document, counting tokens of shards in worker processes
+    """
+    @classmethod
+    def from_file_parallel(cls, filename, workers=None, analyzer=None, instrumentation=None):
+        ii = cls([], analyzer)
+        ii.instrumentation = instrumentation
+        profile = begin(instrumentation, 'build')
+        profile.phase('invert')
+        for doc_lengths, tf in map_shards(partial(count_shard, analyzer=ii.analyzer), filename, workers):
+            # Shift the shard-local document ids by the number of documents before the shard
+            offset = len(ii.doc_lengths)
+            for term, (doc_ids, counts) in tf.items():
+                if term not in ii.tf:
+                    ii.tf[term] = (array('I'), array('I'))
+                ii.tf[term][0].extend(map(offset.__add__, doc_ids) if offset else doc_ids)
+                ii.tf[term][1].extend(counts)
+            ii.doc_lengths.extend(doc_lengths)
+        ii.num_documents = len(ii.doc_lengths)
+        ii.df = {term: len(doc_ids) for term, (doc_ids, _) in ii.tf.items()}
+        profile.phase('weights')
+        ii._compute_postings()
+        ii._compute_norms()
+        profile.count('documents', ii.num_documents)
+        profile.count('tokens', sum(ii.doc_lengths))
+        profile.count('terms', len(ii.postings))
+        profile.finish()
+        return ii
 
     """
     Preprocess a document by splitting it into individual tokens
     """
     def _preprocess(self, text):
-        return re.split('[^a-zA-z]', text.lower())
+        return self.analyzer.tokens(text)
 
     """
-    Build the inverted index
+    Count the terms of every document into per-term arrays of document ids and counts
     """
-    def _build_index(self):
-        for doc_id, tokens in enumerate(self.tokenized_documents):
-            for token in set(tokens):
-                self.inverted_index[token].append(doc_id)
+    def _build_index(self, documents):
+        self.doc_lengths, self.tf = count_terms(documents, self.analyzer)
+        self.df = {term: len(doc_ids) for term, (doc_ids, _) in self.tf.items()}
 
     """
-    Compute term frequencies and document frequencies
+    Store the TF-IDF scores of every term next to its document ids
     """
-    def _tf_df(self):
-        for doc_id, tokens in enumerate(self.tokenized_documents):
-            token_counts = defaultdict(int)
-            for token in tokens:
-                token_counts[token] += 1
-            for token, count in token_counts.items():
-                self.tf[doc_id][token] = count
-                self.df[token] += 1
+    def _compute_postings(self):
+        self.postings = {}
+        for term, (doc_ids, counts) in self.tf.items():
+            idf = math.log(self.num_documents / self.df[term])
+            self.postings[term] = (doc_ids, array('d', [(count / self.doc_lengths[doc_id]) * idf
+                                                        for doc_id, count in zip(doc_ids, counts)]))
 
     """
-    Compute TF-IDF scores
+    Compute the magnitude of every document vector once; the squares are summed in term order, so a
+    document has the same magnitude whichever other documents are indexed with it
     """
-    def _compute_tfidf(self):
-        for doc_id, terms in self.tf.items():
-            for term, count in terms.items():
-                self.tfidf[doc_id][term] = (count / len(self.tokenized_documents[doc_id])) * math.log(
-                    self.num_documents / (self.df[term]))
+    def _compute_norms(self):
+        squares = [0.0] * len(self.doc_lengths)
+        for term in sorted(self.postings):
+            doc_ids, scores = self.postings[term]
+            for doc_id, score in zip(doc_ids, scores):
+                squares[doc_id] += score * score
+        self.doc_norms = array('d', map(math.sqrt, squares))
 
     """
-    Compute the dot product of two vectors
+    Return the statistics a sharded search sums over all shards
     """
-    def _dot_product(self, vec1, vec2):
-        return sum(vec1[term] * vec2.get(term, 0.0) for term in vec1)
+    def local_statistics(self):
+        return {'num_documents': self.num_documents, 'total_len': sum(self.doc_lengths), 'df': dict(self.df)}
 
     """
-    Compute the magnitude of a vector
+    Recompute the TF-IDF weights with the number of documents and document frequencies of a whole
+    sharded collection; queries then weight their terms with the global statistics as well
     """
-    def _magnitude(self, vec):
-        return math.sqrt(sum(val ** 2 for val in vec.values()))
+    def use_global_statistics(self, num_documents, total_len, df):
+        self.num_documents = num_documents
+        self.df = df
+        self._compute_postings()
+        self._compute_norms()
+        self.generation += 1
 
     """
-    Compute the cosine similarity between two vectors
+    Compute the magnitude of a vector
     """
-    def _cosine_similarity(self, vec1, vec2):
-        return self._dot_product(vec1, vec2) / (self._magnitude(vec1) * self._magnitude(vec2))
+    def _magnitude(self, vec):
+        return math.sqrt(sum(val ** 2 for val in vec.values()))
 
     """
-    Search for documents matching a query
+    Search for the k documents most similar to a query, scoring only documents that share a term with it
     """
-    def search(self, query):
-        # Preprocess the query
+    def search(self, query, k=10):
+        profile = begin(self.instrumentation, 'search', query)
+        # Preprocess the query and return its cached result if the index did not change since
+        profile.phase('tokenize')
         query_tokens = self._preprocess(query)
+        profile.phase('cache')
+        key = (tuple(query_tokens), k)
+        results = self.cache.results.get(key, self.generation)
+        if results is not None:
+            profile.count('cache_hits')
+            profile.finish()
+            return list(results)
+        profile.count('cache_misses')
+        profile.phase('weights')
         query_tf = defaultdict(int)
         for token in query_tokens:
             query_tf[token] += 1
         query_tfidf = {
             term: (count / len(query_tokens)) * math.log(self.num_documents / (self.df.get(term, self.num_documents)))
             for term, count in query_tf.items()}
+        query_norm = self._magnitude(query_tfidf)
+        if query_norm == 0:
+            self.cache.results.put(key, self.generation, [])
+            profile.finish()
+            return []
+
+        # Accumulate dot products over the postings of the query terms
+        dot_products = defaultdict(float)
+        for term, weight in query_tfidf.items():
+            if weight == 0:
+                continue
+            profile.phase('postings')
+            doc_ids, scores = self.postings.get(term, ((), ()))
+            profile.phase('score')
+            profile.count('postings_read', len(doc_ids))
+            for doc_id, score in zip(doc_ids, scores):
+                dot_products[doc_id] += weight * score
+
+        # Divide by the precomputed document magnitudes, skipping zero vectors
+        profile.phase('normalize')
+        similarities = [(doc_id, dot / (query_norm * self.doc_norms[doc_id]))
+                        for doc_id, dot in dot_products.items() if self.doc_norms[doc_id] > 0]
+
+        # Return the top k documents with highest similarity scores
+        profile.phase('sort')
+        profile.count('documents_scored', len(similarities))
+        profile.count('heap_operations', len(similarities))
+        results = heapq.nlargest(k, similarities, key=lambda x: (x[1], -x[0]))
+        self.cache.results.put(key, self.generation, results)
+        profile.finish()
+        return list(results)
+
+    """
+    Pickle the index without its instrumentation, e.g. to send it to a worker process; an index
+    loaded from disk cannot be pickled since it reads a memory-mapped file
+    """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['instrumentation'] = None
+        return state
+
+    """
+    Write the postings, TF-IDF scores and document magnitudes to a binary index file
+    """
+    def save(self, path):
+        terms = sorted(self.postings)
+        write_index(path, ((term, *self.postings[term]) for term in terms), values_type='d',
+                    arrays={'doc_norms': ('d', self.doc_norms)},
+                    metadata={'num_documents': self.num_documents, 'analyzer': self.analyzer.config()})
 
-        # Compute similarities between the query and each document
-        similarities = {}
-        for doc_id in range(self.num_documents):
-            similarities[doc_id] = self._cosine_similarity(query_tfidf, self.tfidf[doc_id])
+    """
+    Open a saved index; postings are read lazily from the memory-mapped file and the
+    term counts are not kept
+    """
+    @classmethod
+    def load(cls, path):
+        index_file = IndexFile(path)
+        ii = cls([], Analyzer.from_config(index_file.statistics.get('analyzer')))
+        ii.num_documents = index_file.statistics['num_documents']
+        ii.index_file = index_file
+        ii.doc_norms = index_file.array('doc_norms')
+        ii.df = TermMapping(index_file, lambda i: len(index_file.doc_ids(i)))
+        ii.postings = TermMapping(index_file, lambda i: (index_file.doc_ids(i), index_file.values(i)))
+        return ii
+
+
+"""
+Class SparseInvertedIndex: the same TF-IDF cosine model stored as sparse matrices (requires numpy)
+    - documents: list of documents to build the index from
+    - terms are mapped to integer ids and the TF-IDF matrix is held in CSR form (indptr, indices, data)
+      together with its term-major transpose and the L2 norm of every row; rows are normalized while
+      scoring so that scores are bit-for-bit those of InvertedIndex.search
+"""
+
+class SparseInvertedIndex:
+    def __init__(self, documents, analyzer=None, instrumentation=None):
+        if np is None:
+            raise ImportError("SparseInvertedIndex requires numpy")
+        self.num_documents = len(documents)  # number of documents
+        self.analyzer = analyzer or Analyzer()  # turns documents and queries into tokens
+        self.instrumentation = instrumentation  # profiles searches and builds when given
+        self.vocabulary = Vocabulary()  # term <-> term id
+        self.df = None  # document frequency per term id
+        self.indptr = None  # CSR row pointers (document -> slice of indices/data)
+        self.indices = None  # CSR term ids
+        self.data = None  # CSR TF-IDF weights
+        self.doc_norms = None  # L2 norm of every document row
+        self.term_indptr = None  # transposed row pointers (term -> slice of term_docs/term_data)
+        self.term_docs = None  # transposed document ids
+        self.term_data = None  # transposed TF-IDF weights
+        self._build(documents)
 
-        # Return the top 10 documents with highest similarity scores
-        return sorted(similarities.items(), key=lambda x: x[1], reverse=True)
+    """
+    Preprocess a document by splitting it into individual tokens
+    """
+    def _preprocess(self, text):
+        return self.analyzer.tokens(text)
+
+    """
+    Build the normalized TF-IDF matrix and its transpose
+    """
+    def _build(self, documents):
+        profile = begin(self.instrumentation, 'build')
+        profile.phase('tokenize')
+        rows = []
+        terms = []
+        counts = []
+        lengths = []
+        for doc_id, doc in enumerate(documents):
+            term_ids = self.analyzer.term_ids(doc, self.vocabulary)
+            token_counts = defaultdict(int)
+            for term_id in term_ids:
+                token_counts[term_id] += 1
+            for term_id, count in token_counts.items():
+                rows.append(doc_id)
+                terms.append(term_id)
+                counts.append(count)
+            lengths.append(len(term_ids))
+        profile.phase('weights')
+        profile.count('documents', self.num_documents)
+        profile.count('tokens', sum(lengths))
+        profile.count('terms', len(self.vocabulary))
+        rows = np.array(rows, dtype=np.int64)
+        terms = np.array(terms, dtype=np.int64)
+        self.df = np.bincount(terms, minlength=len(self.vocabulary))
+
+        # Compute the TF-IDF weights and the norm of each document vector, then drop explicit zeros
+        idf = np.array([math.log(self.num_documents / df) for df in self.df.tolist()], dtype=np.float64)
+        weights = np.array(counts, dtype=np.float64) / np.array(lengths, dtype=np.float64)[rows] * idf[terms]
+        # The norms are summed exactly like InvertedIndex._compute_norms, in the order of the terms,
+        # so that scores are bit-identical
+        term_ranks = np.empty(len(self.vocabulary), dtype=np.int64)
+        term_ranks[sorted(range(len(self.vocabulary)), key=self.vocabulary.terms.__getitem__)] = \
+            np.arange(len(self.vocabulary))
+        order = np.argsort(term_ranks[terms], kind='stable')
+        squares = [0.0] * self.num_documents
+        for doc_id, weight in zip(rows[order].tolist(), weights[order].tolist()):
+            squares[doc_id] += weight * weight
+        self.doc_norms = np.array(list(map(math.sqrt, squares)), dtype=np.float64)
+        nonzero = weights != 0
+        rows, terms, weights = rows[nonzero], terms[nonzero], weights[nonzero]
+
+        # Store the document-major CSR arrays
+        self.indptr = np.zeros(self.num_documents + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=self.num_documents), out=self.indptr[1:])
+        self.indices = terms
+        self.data = weights
+
+        # Store the term-major transpose; a stable sort keeps document ids ascending per term
+        order = np.argsort(terms, kind='stable')
+        self.term_indptr = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(self.vocabulary)), out=self.term_indptr[1:])
+        self.term_docs = rows[order]
+        self.term_data = weights[order]
+        profile.finish()
+
+    """
+    Build the query vectors of a batch as (query index, term id, weight) triples plus the query norms
+    """
+    def _query_matrix(self, queries):
+        query_rows = []
+        query_terms = []
+        query_weights = []
+        query_norms = []
+        for query_id, query in enumerate(queries):
+            query_tokens = self._preprocess(query)
+            query_tf = defaultdict(int)
+            for token in query_tokens:
+                query_tf[token] += 1
+            vector = {}
+            for term, count in query_tf.items():
+                term_id = self.vocabulary.get(term)
+                if term_id is not None:
+                    weight = (count / len(query_tokens)) * math.log(self.num_documents / self.df[term_id])
+                    if weight != 0:
+                        vector[term_id] = weight
+            query_norms.append(math.sqrt(sum(val ** 2 for val in vector.values())))
+            for term_id, weight in vector.items():
+                query_rows.append(query_id)
+                query_terms.append(term_id)
+                query_weights.append(weight)
+        return (np.array(query_rows, dtype=np.int64), np.array(query_terms, dtype=np.int64),
+                np.array(query_weights, dtype=np.float64), np.array(query_norms, dtype=np.float64))
+
+    """
+    Search a batch of queries with one sparse product, returning the top k documents for each query
+    """
+    def search_batch(self, queries, k=10):
+        profile = begin(self.instrumentation, 'search_batch', len(queries))
+        profile.phase('weights')
+        results = [[] for _ in queries]
+        query_rows, query_terms, query_weights, query_norms = self._query_matrix(queries)
+        if len(query_terms) == 0 or k <= 0:
+            profile.finish()
+            return results
+
+        # Gather the postings of every (query, term) pair
+        starts = self.term_indptr[query_terms]
+        sizes = self.term_indptr[query_terms + 1] - starts
+        pairs = np.repeat(np.arange(len(query_terms)), sizes)
+        positions = starts[pairs] + np.arange(pairs.size) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        doc_ids = self.term_docs[positions]
+        products = query_weights[pairs] * self.term_data[positions]
+        profile.count('postings_read', pairs.size)
+        profile.phase('score')
+
+        # Accumulate every query row of the sparse product into a dense array of document scores; the
+        # products are added in term order as in InvertedIndex.search, so the scores are bit-identical
+        row_ends = np.cumsum(np.bincount(query_rows[pairs], minlength=len(queries)))
+        accumulator = np.zeros(self.num_documents, dtype=np.float64)
+        # The position of one posting of every document, used to find the documents of a row without sorting
+        marks = np.zeros(self.num_documents, dtype=np.int64)
+        documents_scored = 0
+        row_start = 0
+        for query_id, row_end in enumerate(row_ends.tolist()):
+            if row_end == row_start:
+                continue
+            row_docs = doc_ids[row_start:row_end]
+            np.add.at(accumulator, row_docs, products[row_start:row_end])
+            marks[row_docs] = np.arange(row_docs.size)
+            docs = row_docs[marks[row_docs] == np.arange(row_docs.size)]
+            scores = accumulator[docs] / (query_norms[query_id] * self.doc_norms[docs])
+            accumulator[docs] = 0.0
+            documents_scored += docs.size
+            row_start = row_end
+            # Keep the documents scoring at least the k-th best score, then order only those by
+            # descending score and ascending document id
+            if docs.size > k:
+                kth = -np.partition(-scores, k - 1)[k - 1]
+                best = scores >= kth
+                docs, scores = docs[best], scores[best]
+            order = np.lexsort((docs, -scores))[:k]
+            results[query_id] = list(zip(docs[order].tolist(), scores[order].tolist()))
+        profile.count('documents_scored', documents_scored)
+        profile.finish()
+        return results
+
+    """
+    Search for the k documents most similar to a single query
+    """
+    def search(self, query, k=10):
+        return self.search_batch([query], k)[0]
 
 
 if __name__ == '__main__':
     # Check command-line arguments
-    if len(sys.argv) != 2:
-        print("Usage: python BM25_ranking.py [file_name]")
+    # Serve queries over the network instead of reading one from the terminal when --serve is given
+    serve_address = None
+    if '--serve' in sys.argv[:-1]:
+        position = sys.argv.index('--serve')
+        serve_address = sys.argv.pop(position + 1)
+        sys.argv.pop(position)
+    # Split the documents over worker processes when --shards is given
+    shards = None
+    if '--shards' in sys.argv[:-1]:
+        position = sys.argv.index('--shards')
+        shards = int(sys.argv.pop(position + 1))
+        sys.argv.pop(position)
+    if len(sys.argv) not in (2, 3) or (shards and len(sys.argv) == 3):
+        print("Usage: python tf-idf-cosine_ranking.py [file_name] [save_index_to] [--serve HOST:PORT|unix:PATH]")
+        print("       python tf-idf-cosine_ranking.py [file_name] --shards N [--serve HOST:PORT|unix:PATH]")
         sys.exit(1)
 
-    # Read documents from file
     filename = sys.argv[1]
-    documents = []
-    with open(filename, encoding="utf8") as file:
-        for line in file:
-            documents.append(line.strip())
+    if shards:
+        # Search shards of the file in worker processes that score with the global statistics
+        ii = ShardedIndex(filename, shards, open_shard)
+    elif is_index_file(filename):
+        # Open a previously saved index
+        ii = InvertedIndex.load(filename)
+    else:
+        # Read documents from file
+        documents = []
+        with open(filename, encoding="utf8") as file:
+            for line in file:
+                documents.append(line.strip())
+
+        # Create an InvertedIndex object
+        ii = InvertedIndex(documents)
+
+    # Save the index when a second file name is given
+    if len(sys.argv) == 3:
+        ii.save(sys.argv[2])
 
-    # Create an InvertedIndex object
-    ii = InvertedIndex(documents)
+    # Answer line-delimited JSON requests until interrupted
+    if serve_address is not None:
+        serve(ii, serve_address)
+        sys.exit(0)
 
     # Get query from user
     query = input('Search: ')
 
     # Search for documents matching the query
-    results = ii.search(query)
+    results = ii.search(query, k=10)
     print("Results for query '%s':" % query)
-    for doc_id, score in results[0: 11]:
+    for doc_id, score in results:
         print("Doc %d: score: %.5f" % (doc_id, score))
\ No newline at end of file